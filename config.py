@@ -134,6 +134,11 @@ POLL_PERIOD_EVSE        = 0.5
 POLL_PERIOD_EVSE_METER_CHARGING  = 0.2
 POLL_PERIOD_EVSE_METER_IDLE      = 1 # 10
 
+# Registers not needed for power routing are polled less often, see grugbus.scheduler
+POLL_PERIOD_SLOW        = 1     # voltages, currents, status
+POLL_PERIOD_ENERGY      = 60    # energy counters
+MQTT_KEEPALIVE_PERIOD   = 60    # with skip_unchanged, registers are published when they change, and all of them at this interval
+
 ##################################################################
 # Modbus configuration
 ##################################################################
@@ -146,7 +151,43 @@ POLL_PERIOD_EVSE_METER_IDLE      = 1 # 10
 # because a call to connect() is made before retrying, which sometimes fixes the issue...
 GRUGBUS_RETRIES = 3         # it will do GRUGBUS_RETRIES+1 attempts
 GRUGBUS_RETRY_WAIT_S = 0.2  # how long to wait before retrying
+GRUGBUS_BREAKER_FAILURES = 5        # after this many consecutive failed transactions, a device is offline, see grugbus.breaker
+GRUGBUS_BREAKER_BACKOFF_S = 1.0     # then transactions fail fast for this long before a probe, doubling after each failed probe
+GRUGBUS_BREAKER_BACKOFF_MAX_S = 30.0
+GRUGBUS_ADAPTIVE_TIMEOUT = False    # set timeouts from each device's measured response times, see grugbus.stats.TimeoutEstimator (grugbus.rtu and grugbus.tcp clients only)
+GRUGBUS_TIMEOUT_PERCENTILE = 99     # timeout is this percentile of response times...
+GRUGBUS_TIMEOUT_MARGIN = 2.0        # ...times this margin, plus transfer time
+GRUGBUS_TIMEOUT_MIN_S = 0.03        # floor, the ceiling is the static timeout in the SERIAL config
 GRUGBUS_RATE_LIMIT_ERRORS = 10  # stop logging errors after this number
+GRUGBUS_NUMPY_DECODE = False    # decode bulk reads with numpy (if installed) instead of struct, faster for big float chunks
+GRUGBUS_PLAN_CACHE_SIZE = 64    # max number of register lists per device for which read/write plans are cached
+GRUGBUS_BUS_AGING_S = 1.0       # devices on one modbus client share it by priority, see grugbus.bus: waiting transactions
+                                # are promoted one priority level after waiting this long, so low priorities don't starve
+GRUGBUS_SESSION_MAX_TRANSACTIONS = 8    # a device.session() releases the bus after this many transactions...
+GRUGBUS_SESSION_MAX_S = 0.5             # ...or this long, so it can't starve other devices on the bus
+GRUGBUS_BUS_STATS_PERIOD = 10   # seconds between bus and device statistics publications, see grugbus.stats
+GRUGBUS_COALESCE_WINDOW_S = 0.0 # concurrent overlapping read_regs() calls arriving within this delay are merged into one read
+GRUGBUS_WRITE_COALESCE_WINDOW_S = 0.0  # same for write_regs(), all writes are merged, adjacent registers share transactions
+GRUGBUS_DECODE_ACCIDENTAL = False   # decode registers read by accident in holes of bulk reads, see SlaveDevice.read_regs()
+GRUGBUS_SKIP_UNCHANGED = False      # don't decode chunks whose raw words did not change, see reg.changed
+GRUGBUS_NATIVE_RTU = False      # use grugbus.rtu.RtuClient instead of pymodbus for serial ports, it has less overhead
+GRUGBUS_SERIAL_THREAD = False   # with GRUGBUS_NATIVE_RTU, do serial I/O in one thread per port, see grugbus.rtu.ThreadedRtuClient
+GRUGBUS_RTU_FRAME_CACHE_SIZE = 256  # max number of read request frames kept per serial port by grugbus.rtu.RtuClient
+SHM_POLLERS = False     # read the main meter and the inverters' local meters in their own processes, see grugbus.shm.PollerProcess
+                        # (their registers can't be read through GATEWAYS, only served from cache)
+
+# Bulk reads are planned to minimize bus time, using a cost model derived from the
+# serial settings below (baud rate etc). Parameters can be overridden per device key,
+# see grugbus.plan.CostModel: turnaround, overhead, word_time, bit_time
+GRUGBUS_COST_MODEL = {
+    # "solis1" : { "turnaround" : 0.05 },
+}
+
+# Modbus gateways, to let other masters use our devices without conflicting with our polling, see grugbus.gateway.
+# Each entry serves the listed devices (by key) on a TCP port, framer is "tcp" for Modbus TCP or "rtu" for RTU over TCP.
+GATEWAYS = [
+    # { "port" : 5020, "framer" : "tcp", "devices" : ["meter"], "max_age" : 1.0 },
+]
 
 def PYMODBUS_CLIENT_TWEAKS( client ):
     # Prevent pymodbus from disconnecting the port too fast after failed requests
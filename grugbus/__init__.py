@@ -14,4 +14,15 @@
 
 # import grugbus.register
 from . import registers
-from .device import SlaveDevice, DeviceBase, LocalServer
+from .device import SlaveDevice, DeviceBase, LocalServer, IllegalAddress, DeviceOffline
+from .plan import ReadPlan, WritePlan
+from .scheduler import PollScheduler
+from .observe import Observer
+from .snapshot import Snapshot
+from .bus import BusArbiter, PRIORITY_CONTROL, PRIORITY_FAST, PRIORITY_BULK
+from . import probe
+from . import tcp
+from . import rtu
+from . import stats
+from . import gateway
+from . import shm
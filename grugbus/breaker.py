@@ -0,0 +1,85 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import time, logging
+import config
+
+log = logging.getLogger(__name__)
+
+# Breaker states, published on MQTT as numbers
+CLOSED    = 0   # device is online, transactions go through
+HALF_OPEN = 1   # backoff elapsed, one probe transaction is in progress
+OPEN      = 2   # device is offline, transactions fail fast
+STATE_NAMES = { CLOSED:"closed", HALF_OPEN:"half open", OPEN:"open" }
+
+class CircuitBreaker:
+    """
+        When a device is unplugged, each read would still make all its retries and wait for all
+        timeouts, which wastes bus time that other devices on the same port need.
+
+        After config.GRUGBUS_BREAKER_FAILURES consecutive failed transactions, the breaker opens,
+        and transactions fail fast without touching the bus. After a backoff delay, one single
+        probe transaction is let through: if it works, the breaker closes, otherwise it opens again
+        and the backoff doubles, up to config.GRUGBUS_BREAKER_BACKOFF_MAX_S.
+
+        A device answering with an exception is online, so that counts as a success.
+    """
+    def __init__( self, key, on_change=None ):
+        """
+            :param  on_change:  called with the new state when it changes
+        """
+        self.key          = key
+        self.on_change    = on_change
+        self.state        = CLOSED
+        self.failures     = 0       # consecutive failed transactions
+        self.backoff      = config.GRUGBUS_BREAKER_BACKOFF_S
+        self.open_until   = 0
+
+    def _set_state( self, state ):
+        if state != self.state:
+            self.state = state
+            if self.on_change:
+                self.on_change( state )
+
+    def allow( self ):
+        """
+            Returns True if a transaction can go through.
+        """
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and time.monotonic() >= self.open_until:
+            self._set_state( HALF_OPEN )    # let one probe through
+            return True
+        return False
+
+    @property
+    def probing( self ):
+        return self.state == HALF_OPEN
+
+    def success( self ):
+        self.failures = 0
+        if self.state != CLOSED:
+            log.info( "%s: circuit breaker closed, device is back", self.key )
+            self.backoff = config.GRUGBUS_BREAKER_BACKOFF_S
+            self._set_state( CLOSED )
+
+    def failure( self ):
+        self.failures += 1
+        if self.state == HALF_OPEN:
+            self.backoff = min( self.backoff*2, config.GRUGBUS_BREAKER_BACKOFF_MAX_S )
+            self._open()
+        elif self.state == CLOSED and self.failures >= config.GRUGBUS_BREAKER_FAILURES:
+            self._open()
+
+    def cancel( self ):
+        """
+            Called if a probe transaction was cancelled, so the next one probes again.
+        """
+        if self.state == HALF_OPEN:
+            self.open_until = 0
+            self._set_state( OPEN )
+
+    def _open( self ):
+        log.info( "%s: circuit breaker open after %d failures, next try in %.1fs", self.key, self.failures, self.backoff )
+        self.open_until = time.monotonic() + self.backoff
+        self._set_state( OPEN )
@@ -0,0 +1,221 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import asyncio, time, logging, contextlib
+import config
+
+log = logging.getLogger(__name__)
+
+# Transaction priorities, lower is more urgent
+PRIORITY_CONTROL = 0    # writes, like EVSE current limit
+PRIORITY_FAST    = 1    # registers needed for power routing, read on every tick
+PRIORITY_BULK    = 2    # telemetry
+PRIORITY_NAMES   = { PRIORITY_CONTROL:"control", PRIORITY_FAST:"fast", PRIORITY_BULK:"bulk" }
+
+class BusStats:
+    __slots__ = "count", "wait_total", "wait_max"
+
+    def __init__( self ):
+        self.count      = 0
+        self.wait_total = 0.0
+        self.wait_max   = 0.0
+
+class BusArbiter:
+    """
+        Serializes modbus transactions of all devices on one modbus client (serial port),
+        with priorities: when the bus is released, the most urgent waiting transaction goes next,
+        so a write does not wait behind a queue of telemetry reads.
+
+        Priority only decides the order of queued transactions, a transaction in progress is never interrupted.
+        For fairness, a waiting transaction is promoted one priority level every config.GRUGBUS_BUS_AGING_S,
+        and transactions with the same priority are served in arrival order.
+        Long reads are split into chunks, and each chunk is one transaction, so an urgent write
+        only waits for the chunk in progress.
+
+        There is one arbiter per modbus client, devices get it with BusArbiter.for_client().
+
+        A session holds the bus for several transactions of one task, see session().
+    """
+    def __init__( self, key ):
+        self.key       = key
+        self.devices   = []
+        self.busy      = False
+        self.waiters   = []     # [priority, seq, enqueue time, future]
+        self.seq       = 0
+        self.aging     = config.GRUGBUS_BUS_AGING_S
+        self.queue_max = 0
+        self.stats     = { p:BusStats() for p in PRIORITY_NAMES }
+        self.airtime   = 0.0    # time the bus was busy since stats_start, not counting the current busy period
+        self.busy_start  = 0.0  # when the bus became busy
+        self.stats_start = time.monotonic()
+        self.session_task  = None   # task holding the bus with session()
+        self.session_left  = 0      # transactions left in the session
+        self.session_in_tx = False  # a session transaction is in progress
+
+    @classmethod
+    def for_client( cls, modbus ):
+        """
+            Returns the arbiter for this modbus client, creating it if needed.
+        """
+        arbiter = getattr( modbus, "_grugbus_bus", None )
+        if arbiter is None:
+            p = getattr( modbus, "comm_params", None )
+            arbiter = modbus._grugbus_bus = cls( getattr( p, "host", None ) or "bus" )
+        return arbiter
+
+    def register( self, device ):
+        self.devices.append( device )
+
+    @contextlib.asynccontextmanager
+    async def transaction( self, priority=PRIORITY_BULK ):
+        """
+            async with bus.transaction( PRIORITY_FAST ):
+                ... one modbus transaction ...
+        """
+        if self.in_session():
+            # the bus is already ours
+            self.session_left  -= 1
+            self.session_in_tx  = True
+            try:
+                yield
+            finally:
+                self.session_in_tx = False
+                if self.session_left <= 0:
+                    self._end_session()
+            return
+
+        await self._acquire( priority )
+        try:
+            yield
+        finally:
+            self._release()
+
+    @contextlib.asynccontextmanager
+    async def session( self, priority=PRIORITY_CONTROL, max_transactions=None, max_duration=None ):
+        """
+            Holds the bus for the transactions made by this task inside the block, so a sequence
+            like read, write, read again is not interleaved with other devices' transactions.
+
+                async with bus.session():
+                    await device.read_regs( ... )
+                    await device.write_regs( ... )
+
+            To not starve other devices, the bus is released after max_transactions, or max_duration
+            seconds (config.GRUGBUS_SESSION_MAX_TRANSACTIONS and GRUGBUS_SESSION_MAX_S by default),
+            then the rest of the block continues with normal transactions.
+            Transactions made by other tasks wait until the session ends. Reads and writes made in
+            the session don't join other tasks' reads and writes, since those wait for the session.
+        """
+        if self.in_session():
+            yield   # nested session
+            return
+        await self._acquire( priority )
+        task = asyncio.current_task()
+        self.session_task  = task
+        self.session_left  = max_transactions or config.GRUGBUS_SESSION_MAX_TRANSACTIONS
+        self.session_in_tx = False
+        timer = asyncio.get_running_loop().call_later( max_duration or config.GRUGBUS_SESSION_MAX_S, self._session_timeout, task )
+        try:
+            yield
+        finally:
+            timer.cancel()
+            if self.session_task is task:
+                self._end_session()
+
+    def in_session( self ):
+        """
+            Returns True if the current task holds the bus with session()
+        """
+        return self.session_task is not None and self.session_task is asyncio.current_task()
+
+    def _session_timeout( self, task ):
+        if self.session_task is task:  # not a later session
+            log.info( "%s: session too long, releasing bus", self.key )
+            if self.session_in_tx:
+                self.session_left = 0   # release after this transaction
+            else:
+                self._end_session()
+
+    def _end_session( self ):
+        self.session_task = None
+        self._release()
+
+    async def _acquire( self, priority ):
+        """
+            Waits until the bus is ours
+        """
+        t = time.monotonic()
+        if self.busy:
+            fut = asyncio.get_running_loop().create_future()
+            entry = [priority, self.seq, t, fut]
+            self.seq += 1
+            self.waiters.append( entry )
+            self.queue_max = max( self.queue_max, len( self.waiters ))
+            try:
+                await fut
+            except asyncio.CancelledError:
+                if fut.cancelled():
+                    if entry in self.waiters:
+                        self.waiters.remove( entry )
+                else:
+                    self._release()     # we got the bus, but won't use it
+                raise
+        else:
+            self.busy       = True
+            self.busy_start = t
+
+        wait = time.monotonic() - t
+        s = self.stats[ priority ]
+        s.count      += 1
+        s.wait_total += wait
+        s.wait_max    = max( s.wait_max, wait )
+
+    def _release( self ):
+        # pick most urgent waiter, after promoting the ones that waited too long
+        waiters = self.waiters
+        t = time.monotonic()
+        aging = self.aging
+        while waiters:
+            entry = min( waiters, key=lambda e: (e[0] - (t-e[2])//aging, e[1]) )
+            waiters.remove( entry )
+            if not entry[3].done():     # skip cancelled waiters
+                entry[3].set_result( None )     # bus stays busy, ownership goes to this waiter
+                return
+        self.busy = False
+        self.airtime += t - self.busy_start
+
+    def get_stats( self, reset=True ):
+        """
+            Returns queue depth, wait times per priority, and airtime since the last reset.
+            airtime is the fraction of time the bus was busy, from a transaction or session acquiring
+            it to the last one releasing it, so it can't exceed 1.
+        """
+        t = time.monotonic()
+        airtime = self.airtime
+        if self.busy:
+            airtime += t - self.busy_start
+        r = { "queue_depth":len( self.waiters ), "queue_max":self.queue_max,
+              "airtime":airtime/(t-self.stats_start) if t > self.stats_start else 0 }
+        for p, s in self.stats.items():
+            name = PRIORITY_NAMES[p]
+            r[ name+"_count"    ] = s.count
+            r[ name+"_wait_avg" ] = s.wait_total/s.count if s.count else 0
+            r[ name+"_wait_max" ] = s.wait_max
+        if reset:
+            self.queue_max = len( self.waiters )
+            self.stats = { p:BusStats() for p in PRIORITY_NAMES }
+            self.airtime     = 0.0
+            self.stats_start = t
+            if self.busy:
+                self.busy_start = t     # the rest of the current busy period goes in the next stats
+        return r
+
+    async def publish_coroutine( self, mqtt, mqtt_topic, period=None ):
+        """
+            Periodically publishes get_stats() on MQTT
+        """
+        tick = period or config.GRUGBUS_BUS_STATS_PERIOD
+        while True:
+            await asyncio.sleep( tick )
+            for k, v in self.get_stats().items():
+                mqtt.publish_value( mqtt_topic+k, round( v, 3 ))
@@ -1,15 +1,107 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-import logging, functools, asyncio, time
+import logging, asyncio, time, functools, json, os
 from pymodbus.pdu import ExceptionResponse
 from pymodbus.exceptions import ModbusException, ConnectionException
 from asyncio.exceptions import TimeoutError
 import config
 from misc import *
+from .registers import ChunkDecoder, NumpyChunkDecoder, numpy
+from .plan import ReadPlan, WritePlan, PlanCache, CostModel, AddressIndex, plan_chunks
+from . import probe
+from .bus import BusArbiter, PRIORITY_CONTROL, PRIORITY_FAST, PRIORITY_BULK
+from .stats import TransactionStats, TimeoutEstimator
+from .breaker import CircuitBreaker, CLOSED
+from .observe import Observer
+from .snapshot import Snapshot
 
 log = logging.getLogger(__name__)
 
+class IllegalAddress( ModbusException ):
+    """
+        The device answered with exception code 2 (illegal data address) or 3 (illegal data value),
+        which means the address range can't be read, or the read is too long. Retrying won't help.
+    """
+    pass
+
+class DeviceOffline( ModbusException ):
+    """
+        The device's circuit breaker is open: it failed too many times in a row,
+        so transactions fail fast until the next probe, see grugbus.breaker.
+    """
+    pass
+
+class BatchCancelled( Exception ):
+    """
+        Raised to the followers of a Batch whose leader was cancelled, so they issue their own
+        transactions instead of being cancelled too.
+    """
+    pass
+
+class Batch:
+    """
+        A read_regs() or write_regs() call that other calls can join instead of issuing their own transactions.
+        Until it is started, requests joining it add their registers. Followers wait for its result.
+        Only requests with the same retries can join, since the batch is done with the leader's.
+    """
+    __slots__ = "regs", "plan", "retries", "priority", "started", "followers", "future"
+
+    def __init__( self, regs, plan, retries, priority ):
+        self.regs          = regs
+        self.plan          = plan       # Plan passed by the caller, used if nobody joins
+        self.retries       = retries
+        self.priority      = priority
+        self.started       = False
+        self.followers     = 0
+        self.future        = asyncio.get_running_loop().create_future()
+        self.future.add_done_callback( self._retrieve )
+
+    @staticmethod
+    def _retrieve( future ):
+        # followers that were cancelled don't retrieve the exception, so asyncio would log it
+        if not future.cancelled():
+            future.exception()
+
+    async def join( self, regs, priority ):
+        if not self.started:
+            self.regs |= regs
+            self.priority = min( self.priority, priority )
+        self.followers += 1
+        return await asyncio.shield( self.future )
+
+    async def run( self, window, func ):
+        """
+            Waits window seconds for other calls to join, then returns func( plan or register list, priority )
+            and hands the result (or exception) to followers.
+        """
+        try:
+            await asyncio.sleep( window )
+            self.started = True
+            if self.followers or not self.plan:
+                self.plan = list( self.regs )
+            result = await func( self.plan, self.priority )
+            if self.followers:
+                self.future.set_result( result )
+            return result
+        except BaseException as e:
+            if self.followers:
+                if isinstance( e, asyncio.CancelledError ):
+                    self.future.set_exception( BatchCancelled() )
+                else:
+                    self.future.set_exception( e )
+            raise
+
+class ReadBatch( Batch ):
+    """
+        Once started, only requests for a subset of its registers can join a read, see read_regs().
+    """
+    __slots__ = "max_hole_size",
+
+    def __init__( self, regs, plan, retries, max_hole_size, priority ):
+        super().__init__( regs, plan, retries, priority )
+        self.max_hole_size = max_hole_size
+
 class DeviceBase( ):
     """
         GrugBus brings modbus up to modern Neanderthal tech level, including:
@@ -35,7 +127,13 @@ class DeviceBase( ):
             name,
             registers,
             max_regs_in_command=40,
-            max_bits_in_command=200
+            max_bits_in_command=200,
+            numpy_decode=None,
+            cost_model=None,
+            profile=None,
+            support_fcode23=False,
+            decode_accidental=None,
+            skip_unchanged=None
             ):
         """
             :param  modbus:     Instance of pymodbus server or client
@@ -44,10 +142,21 @@ class DeviceBase( ):
             :param  registers:  List of RegBase derived registers
             :param  max_regs_in_command:    Maximum number of word registers to read/write in one modbus command
             :param  max_bits_in_command:    Maximum number of bit registers to read/write in one modbus command
+            :param  numpy_decode:   Decode bulk reads with numpy instead of struct, default is config.GRUGBUS_NUMPY_DECODE.
+                                    Ignored if numpy is not installed.
+            :param  cost_model:     CostModel used to plan bulk reads, default is derived from modbus serial
+                                    settings, with overrides from config.GRUGBUS_COST_MODEL
+            :param  profile:    Path to a device profile made by grugbus.probe, if it exists it overrides
+                                max_regs_in_command and tells which addresses can't be read.
+            :param  support_fcode23:    Device supports function code 23 (read/write multiple registers),
+                                        used by write_read_regs()
+            :param  decode_accidental:  Also decode registers that sit in holes of bulk reads, see read_regs().
+                                        Default is config.GRUGBUS_DECODE_ACCIDENTAL.
+            :param  skip_unchanged:     Don't decode chunks whose raw words did not change since the last read,
+                                        and set reg.changed. Default is config.GRUGBUS_SKIP_UNCHANGED.
         """
-        # pymodbus has its own mutex now
-        # if not hasattr( modbus, "_async_mutex" ):   # mutex protects serial port if we have more than 1 device banging on it
-            # modbus._async_mutex = asyncio.Lock()
+        # pymodbus has its own mutex, but it serves transactions in arrival order.
+        # Arbiter shares the bus between devices on the same client according to priorities.
         config.PYMODBUS_CLIENT_TWEAKS( modbus )
         self.modbus      = modbus
         self.bus_address = bus_address
@@ -58,17 +167,45 @@ class DeviceBase( ):
         for fcode in 3,4,16:  self.max_regs_in_command[fcode] = max_regs_in_command
 
         self.registers  = []
+        self.plan_cache = PlanCache( config.GRUGBUS_PLAN_CACHE_SIZE )
+        self.unreadable = {}    # fcode: list of [start,end[ address ranges that must not be read
+        self.read_batches = []  # read_regs() calls in progress, see ReadBatch
+        self.write_batch  = None  # write_regs() call waiting for other writes to join
         self.regs_by_key = {}
-        self.addr_belongs_to_reg = {}
+        self.addr_index  = AddressIndex()   # registers by (fcode, address)
         self.regs_by_addr = {}
 
         self.last_transaction_timestamp = 0
         self.last_transaction_period    = 0
         self.last_transaction_duration  = 0
         self.default_retries = config.GRUGBUS_RETRIES+1    # 1 means 1 try and no retry
+        self.cache_hits      = 0    # read_regs() calls served from cache without a transaction, see max_age
+        self.cache_hit_regs  = 0    # registers served from cache
+        self.stats           = TransactionStats()   # latency histograms, errors, airtime, see get_stats()
+        self.breaker         = CircuitBreaker( key, self._on_breaker_change )
+
+        # Class used to decode bulk read chunks
+        if numpy_decode is None:
+            numpy_decode = config.GRUGBUS_NUMPY_DECODE
+        if numpy_decode and numpy:
+            self.chunk_decoder = NumpyChunkDecoder
+        else:
+            self.chunk_decoder = ChunkDecoder
 
         # SDM120 does not like "write register", it needs "write multiple registers" even if there is just one
         self.force_multiple_regiters = False
+        self.support_fcode23 = support_fcode23
+        self.decode_accidental = config.GRUGBUS_DECODE_ACCIDENTAL if decode_accidental is None else decode_accidental
+        self.skip_unchanged    = config.GRUGBUS_SKIP_UNCHANGED if skip_unchanged is None else skip_unchanged
+        self.raw_cache         = {}     # (fcode, start_addr, end_addr): raw words of the last decode of this chunk
+        self.raw_dirty         = set()  # keys of raw_cache for chunks that must be decoded again, see invalidate_raw()
+        self.observers         = {}     # reg: list of Observer, see observe()
+        self.failure_callbacks = []     # called with the device when a transaction fails after its retries, see shm.RegisterStore.attach()
+        self.version           = 0      # incremented by each read that decodes registers, see snapshot()
+        self.version_timestamp = 0
+        self.snapshot_index    = {}     # reg and reg.key: index in Snapshot.values
+        self.snapshot_values   = []     # values as decoded by reads, by index, see snapshot()
+        self._snapshot         = None
         self.ratelimit_error_count = 0
 
         #
@@ -79,10 +216,58 @@ class DeviceBase( ):
         if modbus:
             self.set_modbus( modbus )
 
+        self.cost_model = cost_model or CostModel.from_client( modbus, **config.GRUGBUS_COST_MODEL.get( key, {} ))
+
+        # Timeout is passed to each request, since devices on the same client have different response times.
+        # Only grugbus clients take it: cancelling a request in progress would leave its late response on
+        # a serial port, to be read as the response to the next request.
+        self.timeout_estimator = None
+        if config.GRUGBUS_ADAPTIVE_TIMEOUT and getattr( modbus, "accepts_timeout", False ):
+            self.timeout_estimator = TimeoutEstimator( self.cost_model, modbus.timeout )
+
         # register registers
         for reg in registers:
             self.add_register( reg )
 
+        if profile and os.path.exists( profile ):
+            self.load_profile( profile )
+
+    def load_profile( self, path ):
+        with open( path ) as f:
+            self.apply_profile( json.load( f ))
+
+    def apply_profile( self, profile ):
+        """
+            profile is a dict, as saved by grugbus.probe:
+                "max_regs_in_command":  { fcode: max number of words or bits in one read }
+                "readable":             { fcode: [[start,end], ...] readable address ranges, end not inclusive }
+            Addresses between readable ranges are marked as unreadable, so read plans will not put them in holes.
+        """
+        for fcode, n in profile.get( "max_regs_in_command", {} ).items():
+            self.max_regs_in_command[ int(fcode) ] = n
+        for fcode, ranges in profile.get( "readable", {} ).items():
+            fcode = int(fcode)
+            self.unreadable.pop( fcode, None )
+            ranges = sorted( ranges )
+            for (s0,e0),(s1,e1) in zip( ranges, ranges[1:] ):
+                self.add_unreadable( fcode, e0, s1 )
+        self.plan_cache.clear()
+
+    def add_unreadable( self, fcode, start_addr, end_addr ):
+        """
+            Marks an address range as unreadable, for example because the device answered 
+            "illegal address" when a chunk read through it. Cached plans are flushed.
+        """
+        if start_addr < end_addr:
+            self.unreadable.setdefault( fcode, [] ).append( (start_addr, end_addr) )
+            self.plan_cache.clear()
+
+    def is_readable( self, fcode, start_addr, end_addr ):
+        for s, e in self.unreadable.get( fcode, () ):
+            if s < end_addr and start_addr < e:
+                return False
+        return True
+
     def rate_limit_error( self, old_is_online, increment_counter ):
         if old_is_online:   # it was online and is no longer online.
             self.ratelimit_error_count = 0
@@ -104,8 +289,11 @@ class DeviceBase( ):
             # print( "%5d %s" % (reg.addr, reg.key) )
             if reg.key in self.regs_by_key:    # key must be unique
                 raise KeyError( "Register key %s is duplicated" % reg.key )
+            self.snapshot_index[reg] = self.snapshot_index[reg.key] = len( self.registers )
             self.registers.append( reg )
             self.regs_by_key[reg.key] = reg
+            self.snapshot_values.append( reg.value )
+            self._snapshot = None
             if hasattr( self, reg.key ):
                 raise KeyError( "Register key %s conflicts with member variable name of %s" % (reg.key, self.key) )
 
@@ -118,30 +306,11 @@ class DeviceBase( ):
                     # assert c not in self.regs_by_fcode_addr     # must be unique
                     # self.regs_by_fcode_addr[c] = reg
                 self.regs_by_addr[reg.addr] = reg
-                fcode = reg.fcodes[0]
-                for a in range(reg.word_length):
-                    k = (fcode,reg.addr+a)
-                    if k in self.addr_belongs_to_reg:
-                        self.dump_regs(True)
-                        raise KeyError( "Registers %s and %s overlap, wrong register definition?" % (reg.key, self.addr_belongs_to_reg[k].key) )
-                    self.addr_belongs_to_reg[k] = reg
-
-    # def get_regs_in_range( self, fcode, start_addr, end_addr ):
-    #     """
-    #     Yields: registers fully contained in the address range.
-    #     Note end_addr is not inclusive.
-    #     If a multi-word register is not fully contained inside the address range,
-    #     it will not be considered.
-    #     """
-    #     while start_addr < end_addr:
-    #         reg = self.regs_by_fcode_addr.get( (fcode, start_addr) )
-    #         if reg:
-    #             start_addr += reg.word_length
-    #             if start_addr > end_addr:   # only add this register if we have the whole data for it
-    #                 break
-    #             yield reg
-    #         else:
-    #             start_addr += 1
+                try:
+                    self.addr_index.add( reg.fcodes[0], reg )
+                except KeyError:
+                    self.dump_all_regs(True)
+                    raise
 
 class SlaveDevice( DeviceBase ):
     """######################
@@ -155,6 +324,10 @@ class SlaveDevice( DeviceBase ):
     def set_modbus( self, modbus ):
         # read functions by modbus fcode
         self.modbus = modbus
+        self.bus    = BusArbiter.for_client( modbus )
+        self.bus.register( self )
+        # clients like grugbus.tcp.PipelinedTcpClient can have several requests in flight
+        self.pipeline = getattr( modbus, "max_in_flight", 1 ) > 1
         self._read_funcs = {
                 1:  modbus.read_coils,
                 2:  modbus.read_discrete_inputs,
@@ -162,6 +335,16 @@ class SlaveDevice( DeviceBase ):
                 4:  modbus.read_input_registers
             }
 
+    def session( self, priority=PRIORITY_CONTROL, max_transactions=None, max_duration=None ):
+        """
+            Holds the bus for a sequence of transactions, see BusArbiter.session().
+
+                async with device.session():
+                    await device.read_regs( ... )
+                    await device.write_regs( ... )
+        """
+        return self.bus.session( priority, max_transactions, max_duration )
+
     async def connect( self ):
         if not self.modbus.connected:
             # async with self.modbus._async_mutex:
@@ -171,59 +354,80 @@ class SlaveDevice( DeviceBase ):
                     log.info( "%s: modbus connect", self.key )
                     await self.modbus.connect()
 
-    # function cache requires reg_list to be a tuple
-    def reg_list_to_chunks( self, reg_list, _max_hole_size ):
-        if len(reg_list) == 1:  # fast path
-            reg, = reg_list 
-            return [ (reg.fcodes[0], [(reg.addr, reg.addr+reg.word_length, reg)]) ]
-        return self._reg_list_to_chunks( tuple(reg_list), _max_hole_size )
-
-    @functools.cache
-    def _reg_list_to_chunks( self, reg_list, _max_hole_size ):
+    async def probe( self, fcodes=None, save_path=None ):
         """
-            Converts a list of registers into a list of address ranges
-            in the form (fcode, start_addr, end_addr) to use bulk commands
-            Not a generator because result is cached
+            Finds out the maximum number of registers per read and readable address ranges, 
+            see grugbus.probe. The profile is applied to this device, and saved if save_path is given.
+            This does a lot of modbus transactions, don't use it on a bus with other tasks polling.
         """
-        reg_list = set(reg_list)
-        ops = {}            # make a list of all addresses to hit, contains (start,end) of each register
-        for reg in reg_list:
-            ops.setdefault( reg.fcodes[0], [] ).append( (reg.addr, reg.addr+reg.word_length, reg) )
+        profile = await probe.probe( self, fcodes )
+        self.apply_profile( profile )
+        if save_path:
+            probe.save_profile( save_path, profile )
+        return profile
 
-        result = []
-        for fcode, addrs in ops.items():
-            max_chunk = self.max_regs_in_command[ fcode ]
+    def make_read_plan( self, reg_list, max_hole_size=None ):
+        """
+            Builds a ReadPlan for these registers, to pass to read_regs() in polling loops.
+        """
+        chunks = self._reg_list_to_chunks( reg_list, max_hole_size )
+        if self.decode_accidental:
+            # decode all registers the chunks cover, not only the ones requested
+            chunks = [ (fcode, [ (reg.addr, reg.addr+reg.word_length, reg) for reg in self.addr_index.regs_in_range( fcode, chunk[0][0], chunk[-1][1] ) ])
+                        for fcode, chunk in chunks ]
+        # compile decoders once
+        chunks = [ (fcode, chunk, self.chunk_decoder( fcode, chunk )) for fcode, chunk in chunks ]
+        return ReadPlan( tuple( reg_list ), chunks, max_hole_size )
+
+    def make_write_plan( self, reg_list ):
+        """
+            Builds a WritePlan for these registers, to pass to write_regs().
+            Holes are not allowed when writing, see write_regs().
+        """
+        chunks = self._reg_list_to_chunks( reg_list, 0 )
+        return WritePlan( tuple( reg_list ), [ (fcode, chunk, None) for fcode, chunk in chunks ], 0 )
 
-            if _max_hole_size == None:
-                max_hole_size = int( self.max_regs_in_command[fcode]//2 )
-            else:
-                max_hole_size = _max_hole_size
+    def get_read_plan( self, reg_list, max_hole_size=None ):
+        """
+            Returns a ReadPlan for these registers from the plan cache, building it if needed.
+            If reg_list is already a ReadPlan, it is returned as is.
+        """
+        if isinstance( reg_list, ReadPlan ):
+            return reg_list
+        if len(reg_list) == 1:  # fast path, don't fill the cache with single registers
+            reg, = reg_list 
+            return ReadPlan( (reg,), [ (reg.fcodes[0], [(reg.addr, reg.addr+reg.word_length, reg)], None) ], max_hole_size )
+        key = (ReadPlan, frozenset( reg_list ), max_hole_size)
+        return self.plan_cache.get( key ) or self.plan_cache.put( key, self.make_read_plan( reg_list, max_hole_size ))
 
-            addrs = sorted( addrs, key=lambda a:a[0] )
-            start_addr = addrs[0][0]
-            end_addr   = addrs[-1][1]
-            if max_hole_size and end_addr <= start_addr + max_chunk:
-                result.append(( fcode, addrs ))     # It's already chunk-sized
-            else:
-                start_idx = 0
-                chunk_end_addr = start_addr + max_chunk
-                for idx in range(len(addrs)-1):
-                    reg_end_addr = addrs[idx][1]
-                    if reg_end_addr > chunk_end_addr:           # would register at [idx] be too long to fit in current chunk?
-                        # print("chunk")
-                        result.append(( fcode, addrs[start_idx:idx] )) # back off and make a chunk with previous addresses
-                        start_idx  = idx                        # (not including this register)
-                        chunk_end_addr = addrs[start_idx][0] + max_chunk
-                    if reg_end_addr+max_hole_size < addrs[idx+1][0]:  # do we have a hole and is it too large?
-                        # print("hole")
-                        result.append(( fcode, addrs[start_idx:(idx+1)] ))          # make a chunk with previous addresses plus current one
-                        start_idx  = idx+1
-                        chunk_end_addr = addrs[start_idx][0] + max_chunk
-                remain = addrs[start_idx:]
-                if remain:
-                    result.append(( fcode, remain ))            # process last record
+    def get_write_plan( self, reg_list ):
+        """
+            Returns a WritePlan for these registers from the plan cache, building it if needed.
+            If reg_list is already a WritePlan, it is returned as is.
+        """
+        if isinstance( reg_list, WritePlan ):
+            return reg_list
+        if len(reg_list) == 1:  # fast path
+            reg, = reg_list 
+            return WritePlan( (reg,), [ (reg.fcodes[0], [(reg.addr, reg.addr+reg.word_length, reg)], None) ], 0 )
+        key = (WritePlan, frozenset( reg_list ))
+        return self.plan_cache.get( key ) or self.plan_cache.put( key, self.make_write_plan( reg_list ))
 
+    def reg_list_to_chunks( self, reg_list, _max_hole_size ):
+        return self.get_read_plan( reg_list, _max_hole_size ).chunks
 
+    def _reg_list_to_chunks( self, reg_list, _max_hole_size ):
+        """
+            Converts a list of registers into a list of chunks
+            in the form (fcode, [(reg_start_addr, reg_end_addr, reg), ...]) to use bulk commands
+            Not a generator because result goes into a Plan
+
+            Chunks are planned to minimize bus time according to self.cost_model: reading a hole
+            between registers can be faster than another transaction, or not, depending on baud rate.
+            If _max_hole_size is not None, holes larger than this are never read.
+            Holes containing addresses marked unreadable (see add_unreadable()) are never read.
+        """
+        result = self._plan_chunks( reg_list, _max_hole_size )
         if config.LOG_MODBUS_REGISTER_CHUNKS:
             r = []
             for fcode, chunk in result:
@@ -231,14 +435,29 @@ class SlaveDevice( DeviceBase ):
                 for reg_start_addr, reg_end_addr, reg in chunk:
                     r.append( "        %6d %2d: %s" % (reg_start_addr, reg_end_addr-reg_start_addr, reg.key))
             log.info( "%s: register groups:%s", self.key, "\n".join(r) )
+        return result
 
+    def _plan_chunks( self, reg_list, _max_hole_size ):
+        # _reg_list_to_chunks() without logging, for callers that only estimate costs, see PollScheduler
+        reg_list = set(reg_list)
+        ops = {}            # make a list of all addresses to hit, contains (start,end) of each register
+        for reg in reg_list:
+            ops.setdefault( reg.fcodes[0], [] ).append( (reg.addr, reg.addr+reg.word_length, reg) )
+
+        result = []
+        for fcode, addrs in ops.items():
+            addrs = sorted( addrs, key=lambda a:a[0] )
+            cost  = functools.partial( self.cost_model.cost, fcode )
+            readable = functools.partial( self.is_readable, fcode ) if fcode in self.unreadable else None
+            for chunk in plan_chunks( addrs, cost, self.max_regs_in_command[ fcode ], _max_hole_size, readable ):
+                result.append(( fcode, chunk ))
         return result
 
     def reg_list_interleave( self, frequent_regs, all_regs ):
-        for fcode, chunk in self.reg_list_to_chunks( all_regs , None ):
+        for fcode, chunk, decoder in self.reg_list_to_chunks( all_regs , None ):
             yield [ reg for reg_start_addr, reg_end_addr, reg in chunk] + frequent_regs
 
-    async def read_regs( self, read_list, retries=None, max_hole_size=None ):
+    async def read_regs( self, read_list, retries=None, max_hole_size=None, priority=PRIORITY_BULK, max_age=None ):
         """
             Reads multiple registers. It is much faster than reading registers individually and is
             the preferred way versus calling read() on each register.
@@ -246,81 +465,127 @@ class SlaveDevice( DeviceBase ):
 
             All registers read will have their .value set.
             Registers read "by accident", because they sit between requested registers in a bulk read,
-            will *not* be updated.
+            will *not* be updated, unless decode_accidental is set: then they are decoded and timestamped
+            too, and returned with the registers read, so max_age and PollScheduler don't read them again.
 
             Args:
-                read_list: list of RegBase instances
+                read_list: list of RegBase instances, or a ReadPlan from make_read_plan()
+                max_hole_size: None to let the cost model decide, or maximum number of words
+                    read between registers, see _reg_list_to_chunks(). Ignored if read_list is a ReadPlan
+                priority: transaction priority on the bus, see grugbus.bus
+                max_age: if not None, registers read less than max_age seconds ago are not read again.
+                    They are still returned, as their value is valid.
             
             All registers need not have the same function code, this will issue the appropriate commands.
 
+            Concurrent calls are coalesced: if the registers are already being read by another call,
+            this waits for its result instead of reading them again. Calls for overlapping register sets
+            arriving within config.GRUGBUS_COALESCE_WINDOW_S are merged into one read. Only calls with the
+            same retries and max_hole_size are coalesced.
+
+            If the modbus client can have several requests in flight (see grugbus.tcp), all chunks
+            are requested at once, so the read costs about one round trip instead of one per chunk.
+
             TODO: remove this
             This releases the Modbus mutex between each register chunk (ie, between each modbus command)
             so other tasks trying to access this modbus interface get a chance to run.
         """
+        if isinstance( read_list, ReadPlan ):
+            plan = read_list
+            regs = set( plan.regs )
+        else:
+            plan = None
+            regs = set( read_list )
+
+        if max_age is not None:
+            t = time.monotonic() - max_age
+            fresh = [ reg for reg in regs if reg.timestamp >= t ]
+            if fresh:
+                self.cache_hit_regs += len( fresh )
+                if len( fresh ) == len( regs ):
+                    self.cache_hits += 1
+                    return fresh
+                regs.difference_update( fresh )
+                return fresh + await self.read_regs( regs, retries, max_hole_size, priority )
+
+        if self.bus.in_session():
+            # other reads are waiting for our session to end, so don't join them
+            return await self._read_regs( plan or list( regs ), retries, max_hole_size, priority )
+
+        # join a read in progress
+        retries = retries or self.default_retries
+        for batch in self.read_batches:
+            if batch.max_hole_size != max_hole_size or batch.retries != retries:
+                continue
+            if batch.started:
+                if not regs <= batch.regs:
+                    continue
+            elif regs.isdisjoint( batch.regs ):
+                continue
+            try:
+                result = await batch.join( regs, priority )
+            except BatchCancelled:
+                return await self.read_regs( regs, retries, max_hole_size, priority )
+            return [ reg for reg in result if reg in regs ]
+
+        # the batch gets its own set, since followers add their registers to it
+        batch = ReadBatch( set( regs ), plan, retries, max_hole_size, priority )
+        self.read_batches.append( batch )
+        try:
+            result = await batch.run( config.GRUGBUS_COALESCE_WINDOW_S,
+                lambda plan, priority: self._read_regs( plan, retries, max_hole_size, priority ))
+        finally:
+            self.read_batches.remove( batch )
+        if batch.followers:     # like followers, only return our registers
+            return [ reg for reg in result if reg in regs ]
+        return result
+
+    async def _read_regs( self, read_list, retries, max_hole_size, priority ):
         retries = retries or self.default_retries
         old_is_online = self.is_online
         try:
             start_time = time.monotonic()
-            # modbus_time = 0
-            # mutex_time = 0
+            plan = self.get_read_plan( read_list, max_hole_size )
             update_list = []
-            for fcode, chunk in self.reg_list_to_chunks( read_list, max_hole_size ):
+            split = False
+            results = None
+            if self.pipeline and len( plan.chunks ) > 1:
+                # one breaker decision and retry for the batch, chunks that failed are retried below
+                results = await self._retry( "read", retries, old_is_online, self._read_chunks_pipelined, plan.chunks, priority )
+            for n, (fcode, chunk, decoder) in enumerate( plan.chunks ):
                 # print( fcode, ":", " ".join( "%d-%d" % (c[0],c[1]) for c in chunk ))
-                func = self._read_funcs.get( fcode )
-                if not func: 
-                    raise ValueError( "Function code %s not supported for read_regs()" % fcode )
-
                 # modbus bulk read
                 start_addr  = chunk[0][0]
                 end_addr    = chunk[-1][1]
-                for retry in range( retries ):
-                    await self.connect()
-                    try:
-                        # mutex_time -= time.monotonic()
-                        # async with self.modbus._async_mutex:    # share same serial port between several tasks
-                        # st = time.monotonic()
-                        # mutex_time += st
-                        resp = await func( start_addr, end_addr-start_addr, self.bus_address )
-                        # modbus_time += time.monotonic() - st
-                        if isinstance( resp, ExceptionResponse ):
-                            raise ModbusException( str( resp ) )
-                        if fcode != 2:
-                            reg_data = resp.registers
-                        else:
-                            reg_data = resp.bits
-                        # if self.modbus._async_mutex._waiters:
-                            # wait until serial is flushed before releasing lock, 
-                            # do not use asyncio sleep, we're in a hurry to release it
-                            # time.sleep(0.001)  
-                        update_list.append( (fcode, chunk, start_addr, reg_data) )
-                        break
-                    except (TimeoutError,ModbusException,ConnectionException) as e:
-                        is_err = retry == retries-1
-                        msg = self.rate_limit_error(old_is_online, is_err)
-                        if not is_err:
-                            if msg:
-                                log.info( "Modbus read error: %s will retry %d/%d (%s)", self.key, retry+1, retries, e )
-                        else:
-                            if msg:
-                                log.error( "Modbus read error: %s after %d/%d tries (%s) %s", self.key, retry+1, retries, e, msg )
+                try:
+                    reg_data = results[n] if results else None
+                    if isinstance( reg_data, IllegalAddress ):
+                        raise reg_data
+                    if reg_data is None or isinstance( reg_data, Exception ):
+                        # not pipelined, or pipelined read failed: read this chunk with retries
+                        reg_data = await self._read_chunk_retry( fcode, start_addr, end_addr-start_addr, retries, old_is_online, priority )
+                except IllegalAddress:
+                    if len(chunk) == 1:
+                        if not self._skip_unreadable_reg( fcode, chunk[0], plan.regs ):
                             raise
-                        await asyncio.sleep(config.GRUGBUS_RETRY_WAIT_S)  # let other tasks use this serial port
+                    else:
+                        # Something in the holes of this chunk can't be read, or it is too long for the device.
+                        # Split it until it works, instead of failing the whole read.
+                        await self._split_chunk( fcode, chunk, retries, old_is_online, update_list, priority, plan.regs )
+                    split = True
+                else:
+                    update_list.append( (fcode, chunk, decoder, start_addr, reg_data) )
+
+            if split:
+                # Unreadable holes were found: re-plan around them, so we don't have to split again next time.
+                # This updates the plan in place, which also fixes it in the plan cache and in the caller.
+                plan.chunks = self.make_read_plan( plan.regs, plan.max_hole_size ).chunks
 
             # Decode values and assign to registers. Do this in a separate loop after reading,
             # to make sure all registers were processed. Otherwise, due to the await above,
             # a mix of old and new values could be present in the object during the read
             # and seen by other coroutines
-            result = []
-            if update_list:
-                self.is_online = True
-                for fcode, chunk, start_addr, reg_data in update_list:
-                    for reg_start_addr, reg_end_addr, reg in chunk:
-                        offset = reg.addr - start_addr
-                        reg.decode( fcode, reg_data[ offset:(offset+reg.word_length) ] )
-                        result.append( reg )
-                if not old_is_online:
-                    log.info( "Modbus: %s (%s) is online" % (self.key, self.name) )
-            return result
+            return self._decode_update_list( update_list, old_is_online )
         except Exception as e:
             self.is_online = False
             raise
@@ -332,10 +597,294 @@ class SlaveDevice( DeviceBase ):
                 if "r" in cfg[0] or slow:
                     self.publish_modbus_timings()
                 if slow:
-                    # log.info("%s: slow modbus read: [mutex %.03fs modbus %.03fs]/%.03fs retry %s", 
-                    #     self.key, mutex_time, modbus_time, self.last_transaction_duration, retry ) # , [reg.key for reg in read_list])
-                    log.info("%s: slow modbus read: %.03fs retry %s", 
-                        self.key, self.last_transaction_duration, retry ) # , [reg.key for reg in read_list])
+                    log.info("%s: slow modbus read: %.03fs", self.key, self.last_transaction_duration ) # , [reg.key for reg in read_list])
+
+    def _decode_update_list( self, update_list, old_is_online ):
+        """
+            Decodes data read by read_regs(), update_list contains (fcode, chunk, decoder, start_addr, reg_data)
+            Returns the list of registers decoded.
+
+            If skip_unchanged is set, chunks with the same raw words as their last decode are not decoded
+            again, and reg.changed tells which registers have new raw words.
+        """
+        result = []
+        if update_list:
+            self.is_online = True
+            raw_cache = self.raw_cache if self.skip_unchanged else None
+            for fcode, chunk, decoder, start_addr, reg_data in update_list:
+                if raw_cache is not None:
+                    key  = (fcode, start_addr, chunk[-1][1])
+                    prev = raw_cache.get( key )
+                    if prev == reg_data and key not in self.raw_dirty:
+                        # Nothing changed: registers still hold the values decoded from these words
+                        for reg_start_addr, reg_end_addr, reg in chunk:
+                            reg.changed = False
+                            result.append( reg )
+                        continue
+                    # Registers will be decoded from this chunk, so other chunks containing them are stale
+                    self._drop_raw( *key )
+                    raw_cache[ key ] = reg_data
+                    for reg_start_addr, reg_end_addr, reg in chunk:
+                        offset = reg.addr - start_addr
+                        reg.changed = prev is None or prev[ offset:(offset+reg.word_length) ] != reg_data[ offset:(offset+reg.word_length) ]
+                if decoder:     # decode the whole chunk at once
+                    decoder.decode( reg_data )
+                    result.extend( reg for reg_start_addr, reg_end_addr, reg in chunk )
+                else:
+                    for reg_start_addr, reg_end_addr, reg in chunk:
+                        offset = reg.addr - start_addr
+                        reg.decode( fcode, reg_data[ offset:(offset+reg.word_length) ] )
+                        result.append( reg )
+            if not old_is_online:
+                log.info( "Modbus: %s (%s) is online" % (self.key, self.name) )
+            t = time.monotonic()
+            for reg in result:
+                reg.timestamp = t
+            self.version += 1
+            self.version_timestamp = t
+            self._update_snapshot( result )
+            if self.observers:
+                self._notify_observers( result )
+        return result
+
+    def _update_snapshot( self, regs ):
+        # called where the version is bumped with the registers decoded by that read, so later
+        # changes to reg.value by the application don't end up in snapshots
+        values = self.snapshot_values
+        index  = self.snapshot_index
+        for reg in regs:
+            values[ index[ reg ]] = reg.value
+
+    def snapshot( self ):
+        """
+            Returns a Snapshot of all register values as decoded by the last read. Reads only record
+            the values they decoded, the Snapshot is made on the first call after a read, and values
+            modified by the application afterwards are not in it.
+        """
+        snap = self._snapshot
+        if snap is None or snap.version != self.version:
+            snap = self._snapshot = Snapshot( self.version, self.version_timestamp, tuple( self.snapshot_values ), self.snapshot_index )
+        return snap
+
+    def observe( self, regs, callback=None, deadband=0 ):
+        """
+            Returns an Observer notified after each read with the registers in regs whose value
+            changed by more than deadband, see observe.Observer.
+        """
+        obs = Observer( regs, callback, deadband )
+        for reg in obs.regs:
+            self.observers.setdefault( reg, [] ).append( obs )
+        return obs
+
+    def unobserve( self, obs ):
+        for reg in obs.regs:
+            l = self.observers.get( reg )
+            if l and obs in l:
+                l.remove( obs )
+                if not l:
+                    del self.observers[ reg ]
+
+    def _notify_observers( self, regs ):
+        # one batch per observer, with all its registers from this read
+        batches = {}
+        for reg in regs:
+            for obs in self.observers.get( reg, () ):
+                batches.setdefault( obs, [] ).append( reg )
+        for obs, obs_regs in batches.items():
+            obs.update( obs_regs )
+
+    def _overlapping_raw( self, fcode, start_addr, end_addr ):
+        return [ key for key in self.raw_cache if key[0] == fcode and key[1] < end_addr and start_addr < key[2] ]
+
+    def _drop_raw( self, fcode, start_addr, end_addr ):
+        for key in self._overlapping_raw( fcode, start_addr, end_addr ):
+            del self.raw_cache[ key ]
+            self.raw_dirty.discard( key )
+
+    def invalidate_raw( self, regs ):
+        """
+            With skip_unchanged, call this after modifying the value of registers, so they
+            are decoded again on the next read even if their raw words did not change.
+        """
+        if self.raw_cache:
+            for reg in regs:
+                self.raw_dirty.update( self._overlapping_raw( reg.fcodes[0], reg.addr, reg.addr+reg.word_length ))
+
+    async def _read_chunk( self, fcode, start_addr, count, priority=PRIORITY_BULK ):
+        """
+            One modbus read transaction, without retries. Returns the list of words (or bits).
+            Raises IllegalAddress if the device says this address range can't be read.
+        """
+        async with self.bus.transaction( priority ):
+            return await self._request_chunk( fcode, start_addr, count )
+
+    async def _read_chunks_pipelined( self, chunks, priority ):
+        """
+            Sends read requests for all chunks without waiting for responses, in one bus transaction.
+            Returns the list of words (or bits) for each chunk, or the exception if that chunk failed.
+            If all chunks failed, raises the first error, so _retry() counts it as a failed transaction.
+        """
+        async with self.bus.transaction( priority ):
+            t = time.monotonic()
+            results = await asyncio.gather( *( self._request_chunk( fcode, chunk[0][0], chunk[-1][1]-chunk[0][0], pipelined=True )
+                                               for fcode, chunk, decoder in chunks ), return_exceptions=True )
+            self.stats.airtime += time.monotonic() - t  # requests overlap, so count the batch once
+        errors = [ r for r in results if isinstance( r, Exception ) and not isinstance( r, IllegalAddress ) ]
+        if len( errors ) == len( results ):
+            raise errors[0]
+        return results
+
+    async def _request_chunk( self, fcode, start_addr, count, pipelined=False ):
+        func = self._read_funcs.get( fcode )
+        if not func: 
+            raise ValueError( "Function code %s not supported for read_regs()" % fcode )
+        t = time.monotonic()
+        resp = await func( start_addr, count, self.bus_address, **self._timeout_arg( fcode, count ))
+        self._add_sample( fcode, count, time.monotonic()-t, airtime=0 if pipelined else None )
+        if isinstance( resp, ExceptionResponse ):
+            if resp.exception_code in (2,3):    # illegal address, illegal value (some devices use it for bad length)
+                raise IllegalAddress( str( resp ) )
+            raise ModbusException( str( resp ) )
+        if fcode > 2:
+            return resp.registers
+        else:
+            return resp.bits
+
+    async def _read_chunk_retry( self, fcode, start_addr, count, retries, old_is_online, priority ):
+        return await self._retry( "read", retries, old_is_online, self._read_chunk, fcode, start_addr, count, priority )
+
+    async def _retry( self, what, retries, old_is_online, func, *args ):
+        """
+            Returns await func( *args ), retrying on modbus errors.
+            If the circuit breaker is open, raises DeviceOffline without using the bus.
+        """
+        breaker = self.breaker
+        for retry in range( retries ):
+            if not breaker.allow():
+                self._failed()
+                raise DeviceOffline( "%s: offline, circuit breaker is open" % self.key )
+            try:
+                await self.connect()
+                result = await func( *args )
+                breaker.success()
+                return result
+            except IllegalAddress:
+                breaker.success()   # the device answered
+                raise       # retrying won't help
+            except asyncio.CancelledError:
+                breaker.cancel()
+                raise
+            except (TimeoutError,ModbusException,ConnectionException) as e:
+                breaker.failure()
+                # don't retry if the breaker opened, or this was a probe
+                is_err = retry == retries-1 or breaker.state != CLOSED
+                if isinstance( e, TimeoutError ):
+                    self.stats.timeouts += 1
+                    if self.timeout_estimator:
+                        self.timeout_estimator.timeout_expired()
+                if is_err:
+                    self.stats.errors += 1
+                else:
+                    self.stats.retries += 1
+                msg = self.rate_limit_error(old_is_online, is_err)
+                if not is_err:
+                    if msg:
+                        log.info( "Modbus %s error: %s will retry %d/%d (%s)", what, self.key, retry+1, retries, e )
+                else:
+                    if msg:
+                        log.error( "Modbus %s error: %s after %d/%d tries (%s) %s", what, self.key, retry+1, retries, e, msg )
+                    self._failed()
+                    raise
+                await asyncio.sleep(config.GRUGBUS_RETRY_WAIT_S)  # let other tasks use this serial port
+            except Exception:
+                # anything else, like OSError from an unplugged USB adapter, is a failure too,
+                # otherwise a probe would leave the breaker half open forever
+                breaker.failure()
+                self.stats.errors += 1
+                self._failed()
+                raise
+
+    def _failed( self ):
+        """
+            Called by _retry() when a transaction failed for good: the device is offline
+        """
+        self.is_online = False
+        for callback in self.failure_callbacks:
+            try:
+                callback( self )
+            except Exception:
+                log.exception( "%s: failure callback", self.key )
+
+    async def _split_chunk( self, fcode, chunk, retries, old_is_online, update_list, priority, requested ):
+        """
+            Called when reading a chunk raised IllegalAddress: bisects it until all parts can be read,
+            and appends the parts to update_list like read_regs() does.
+            If both halves can be read, either the hole between them can't be read, then it is remembered
+            as unreadable and future plans won't read through it, or the chunk was too long for the device,
+            then max_regs_in_command is lowered. The hole is read alone to tell which.
+            requested are the registers the caller asked for, see _skip_unreadable_reg().
+        """
+        mid = len(chunk)//2
+        split = False
+        for half in chunk[:mid], chunk[mid:]:
+            start_addr = half[0][0]
+            end_addr   = half[-1][1]
+            try:
+                reg_data = await self._read_chunk_retry( fcode, start_addr, end_addr-start_addr, retries, old_is_online, priority )
+            except IllegalAddress:
+                if len(half) == 1:
+                    if not self._skip_unreadable_reg( fcode, half[0], requested ):
+                        raise
+                else:
+                    await self._split_chunk( fcode, half, retries, old_is_online, update_list, priority, requested )
+                split = True
+            else:
+                update_list.append( (fcode, half, self.chunk_decoder( fcode, half ), start_addr, reg_data) )
+
+        if not split:
+            start_addr = chunk[mid-1][1]
+            end_addr   = chunk[mid][0]
+            log.info( "%s: can't read chunk %d [%d,%d[, splitting at [%d,%d[", self.key, fcode, chunk[0][0], chunk[-1][1], start_addr, end_addr )
+            if start_addr < end_addr:
+                try:
+                    await self._read_chunk_retry( fcode, start_addr, end_addr-start_addr, retries, old_is_online, priority )
+                except IllegalAddress:
+                    self.add_unreadable( fcode, start_addr, end_addr )
+                    return
+            # the hole can be read, or there is none, so the chunk was too long for the device
+            log.info( "%s: chunk %d [%d,%d[ is too long", self.key, fcode, chunk[0][0], chunk[-1][1] )
+            self.max_regs_in_command[ fcode ] = max( chunk[mid-1][1]-chunk[0][0], chunk[-1][1]-chunk[mid][0] )
+            self.plan_cache.clear()
+
+    def _skip_unreadable_reg( self, fcode, entry, requested ):
+        """
+            A chunk was split down to this register, and it can't be read. If the caller asked for it,
+            returns False: it's an error. Otherwise it was only in the chunk because of decode_accidental,
+            so its range is remembered as unreadable, future plans won't read through it, and the read
+            goes on without it.
+        """
+        reg_start_addr, reg_end_addr, reg = entry
+        if reg in requested:
+            return False
+        log.info( "%s: can't read %s [%d,%d[, skipping it", self.key, reg.key, reg_start_addr, reg_end_addr )
+        self.add_unreadable( fcode, reg_start_addr, reg_end_addr )
+        return True
+
+    def _timeout_arg( self, fcode, count ):
+        """
+            Keyword arguments for one client request: the adaptive timeout, if enabled
+        """
+        if self.timeout_estimator:
+            return { "timeout": self.timeout_estimator.timeout( fcode, count ) }
+        return {}
+
+    def _add_sample( self, fcode, count, duration, write_count=0, airtime=None ):
+        """
+            Records a transaction duration in stats and timeout estimator
+        """
+        self.stats.add( fcode, count, duration, write_count, airtime )
+        if self.timeout_estimator:
+            self.timeout_estimator.add( fcode, count+write_count, duration )
 
     def _set_timings( self, start_time ):
         t = time.monotonic()
@@ -346,13 +895,37 @@ class SlaveDevice( DeviceBase ):
 
 
     def publish_modbus_timings( self ):
+        if not getattr( self, "mqtt", None ):
+            return      # devices in a poller process, see grugbus.shm
         if self.last_transaction_duration:
             self.mqtt.publish_value( self.mqtt_topic+"req_time",   round( self.last_transaction_duration, 2 ))
         if config.LOG_MODBUS_REQUEST_PERIOD and self.last_transaction_period:
             self.mqtt.publish_value( self.mqtt_topic+"req_period", round( self.last_transaction_period, 2 ))
+        if self.cache_hits:
+            self.mqtt.publish_value( self.mqtt_topic+"cache_hits",     self.cache_hits )
+            self.mqtt.publish_value( self.mqtt_topic+"cache_hit_regs", self.cache_hit_regs )
 
+    def _on_breaker_change( self, state ):
+        if getattr( self, "mqtt", None ):
+            self.mqtt.publish_value( self.mqtt_topic+"breaker", state )
 
-    async def write_regs( self, write_list, retries=None ):
+    def get_stats( self, reset=True ):
+        """
+            Returns transaction statistics since the last reset, see grugbus.stats.TransactionStats
+        """
+        return self.stats.get_stats( reset )
+
+    async def publish_stats_coroutine( self, period=None ):
+        """
+            Periodically publishes get_stats() on MQTT, under mqtt_topic/stats/
+        """
+        tick = period or config.GRUGBUS_BUS_STATS_PERIOD
+        while True:
+            await asyncio.sleep( tick )
+            for k, v in self.get_stats().items():
+                self.mqtt.publish_value( self.mqtt_topic+"stats/"+k, round( v, 4 ))
+
+    async def write_regs( self, write_list, retries=None, priority=PRIORITY_CONTROL ):
         """
             Writes multiple registers. 
             Modbus transactions will be chunked to stay under the limit max_regs_in_command.
@@ -374,79 +947,68 @@ class SlaveDevice( DeviceBase ):
             If it contains multiple words (including one 32-bit value which is 2 words)
             then a multi write command will be issued.
 
+            Concurrent calls arriving within config.GRUGBUS_WRITE_COALESCE_WINDOW_S are merged, so
+            adjacent registers written by different callers (or in asyncio.gather()) share transactions.
+            A call is not merged if the merged write would need to split a run of adjacent registers
+            because of max_regs_in_command, since that could split the registers of one call across
+            transactions. Each call returns when the merged write is done. Values are encoded when the write starts,
+            so if several callers write the same register, the last value set wins.
+
             Args:
-                write_list: list of RegBase instances
+                write_list: list of RegBase instances, or a WritePlan from make_write_plan()
                 retries   : if there is a modbus timeout, will retry up to the number specified
+                priority  : transaction priority on the bus, see grugbus.bus
         """
+        if isinstance( write_list, WritePlan ):
+            plan = write_list
+            regs = set( plan.regs )
+        else:
+            plan = None
+            regs = set( write_list )
+
+        if self.bus.in_session():
+            return await self._write_regs( plan or list( regs ), retries, priority )
+
+        retries = retries or self.default_retries
+        batch   = self.write_batch
+        if batch and not batch.started and batch.retries == retries and self._fits_one_write( batch.regs | regs ):
+            try:
+                return await batch.join( regs, priority )
+            except BatchCancelled:
+                return await self.write_regs( regs, retries, priority )
+
+        batch = self.write_batch = Batch( regs, plan, retries, priority )
+        try:
+            return await batch.run( config.GRUGBUS_WRITE_COALESCE_WINDOW_S,
+                lambda plan, priority: self._write_regs( plan, retries, priority ))
+        finally:
+            if self.write_batch is batch:
+                self.write_batch = None
+
+    def _fits_one_write( self, regs ):
+        # True if no run of adjacent registers is split across transactions by max_regs_in_command
+        prev = None
+        for fcode, chunk, decoder in self.get_write_plan( list( regs )).chunks:
+            if prev == (fcode, chunk[0][0]):
+                return False
+            prev = fcode, chunk[-1][1]
+        return True
+
+    async def _write_regs( self, write_list, retries, priority ):
         retries = retries or self.default_retries
         old_is_online = self.is_online
+        plan = self.get_write_plan( write_list )
         try:
             start_time = time.monotonic()
             update_list = []
-            for fcode, chunk in self.reg_list_to_chunks( write_list, 0 ):
-                # check address span of this write operation and build data buffer
-                start_addr = chunk[0][0]
-                end_addr   = chunk[-1][1]
-                reg_data   = [None] * (end_addr-start_addr)
-
-                # encode data in buffer
-                for reg_start_addr, reg_end_addr, reg in chunk:
-                    offset = reg.addr - start_addr
-                    reg_data[ offset:(offset+reg.word_length) ] = reg.encode()
-
-                # in case a register returned too much data
-                assert len(reg_data) == end_addr-start_addr          
-
-                # check for holes (if reg_list_to_chunks malfunctioned)
-                # or if there was a struct register with a hole in the middle
-                if None in reg_data:
-                    raise IndexError("write_regs() cannot write a chunk of registers with a hole in it, as that would overwrite an unknown register")
-                update_list.append( (fcode, start_addr, reg_data) )
-
+            for fcode, chunk, decoder in plan.chunks:
+                update_list.append( (fcode, chunk[0][0], self._encode_chunk( chunk )) )
 
             # Perform modbus writes. Do this in a separate loop after preparing data to write,
             # otherwise, due to the await, a mix of old and new values could be written.
             for fcode, start_addr, reg_data in update_list:
-                for retry in range( retries ):
-                    await self.connect()
-                    try:
-                        # async with self.modbus._async_mutex:
-                        if 1:
-                            if fcode in (1,5):     # we're dealing with bools (force coil)
-                                if len(reg_data) == 1:    
-                                    fcode = 5   # force single coil
-                                    # print( "write_coil", fcode, start_addr, reg_data )
-                                    resp = await self.modbus.write_coil( start_addr, reg_data[0], self.bus_address )
-                                else:                     
-                                    fcode = 15  # force multiple coils
-                                    # print( "write_coils", fcode, start_addr, reg_data )
-                                    resp = await self.modbus.write_coils( start_addr, reg_data, self.bus_address )
-                            elif fcode in (3,6,16):   # we're dealing with words (registers)
-                                if len(reg_data) == 1 and not self.force_multiple_regiters:    
-                                    fcode = 6   # force single register
-                                    # print( "write_register", fcode, start_addr, reg_data )
-                                    resp = await self.modbus.write_register( start_addr, reg_data[0], self.bus_address )
-                                else:                     
-                                    fcode = 16  # force multiple registers
-                                    # print( "write_registers", fcode, start_addr, reg_data )
-                                    resp = await self.modbus.write_registers( start_addr, reg_data, self.bus_address )
-                            else:
-                                raise ValueError( "wrong function code %r in write_regs()" % (fcode,) )
-                        if isinstance( resp, ExceptionResponse ):
-                            raise ModbusException( str( resp ))
-                        self.is_online = True
-                        break
-                    except (TimeoutError,ModbusException,ConnectionException) as e:
-                        is_err = retry == retries-1
-                        msg = self.rate_limit_error(old_is_online, is_err)
-                        if not is_err:
-                            if msg:
-                                log.info( "Modbus write error: %s will retry %d/%d (%s)", self.key, retry+1, retries, e )
-                        else:
-                            if msg:
-                                log.error( "Modbus write error: %s after %d/%d tries (%s) %s", self.key, retry+1, retries, e, msg )
-                            raise
-                        await asyncio.sleep(config.GRUGBUS_RETRY_WAIT_S)  # let other tasks use this serial port
+                await self._retry( "write", retries, old_is_online, self._write_chunk, fcode, start_addr, reg_data, priority )
+                self.is_online = True
 
         except Exception as e:
             self.is_online = False
@@ -459,7 +1021,126 @@ class SlaveDevice( DeviceBase ):
                 if "w" in cfg[0] or slow:
                     self.publish_modbus_timings()
                 if slow:
-                    log.info("%s: slow modbus write: %.03fs %s", self.key, self.last_transaction_duration, [reg.key for reg in write_list])
+                    log.info("%s: slow modbus write: %.03fs %s", self.key, self.last_transaction_duration, [reg.key for reg in plan.regs])
+
+    async def _write_chunk( self, fcode, start_addr, reg_data, priority ):
+        """
+            One modbus write transaction, without retries.
+        """
+        async with self.bus.transaction( priority ):
+            kw = self._timeout_arg( fcode, len(reg_data) )
+            t = time.monotonic()
+            if fcode in (1,5):     # we're dealing with bools (force coil)
+                if len(reg_data) == 1:    
+                    fcode = 5   # force single coil
+                    # print( "write_coil", fcode, start_addr, reg_data )
+                    resp = await self.modbus.write_coil( start_addr, reg_data[0], self.bus_address, **kw )
+                else:                     
+                    fcode = 15  # force multiple coils
+                    # print( "write_coils", fcode, start_addr, reg_data )
+                    resp = await self.modbus.write_coils( start_addr, reg_data, self.bus_address, **kw )
+            elif fcode in (3,6,16):   # we're dealing with words (registers)
+                if len(reg_data) == 1 and not self.force_multiple_regiters:    
+                    fcode = 6   # force single register
+                    # print( "write_register", fcode, start_addr, reg_data )
+                    resp = await self.modbus.write_register( start_addr, reg_data[0], self.bus_address, **kw )
+                else:                     
+                    fcode = 16  # force multiple registers
+                    # print( "write_registers", fcode, start_addr, reg_data )
+                    resp = await self.modbus.write_registers( start_addr, reg_data, self.bus_address, **kw )
+            else:
+                raise ValueError( "wrong function code %r in write_regs()" % (fcode,) )
+            self._add_sample( fcode, len(reg_data), time.monotonic()-t )
+        if isinstance( resp, ExceptionResponse ):
+            raise ModbusException( str( resp ))
+
+    def _encode_chunk( self, chunk ):
+        """
+            Returns the data buffer to write a chunk of registers
+        """
+        # check address span of this write operation and build data buffer
+        start_addr = chunk[0][0]
+        end_addr   = chunk[-1][1]
+        reg_data   = [None] * (end_addr-start_addr)
+
+        # encode data in buffer
+        for reg_start_addr, reg_end_addr, reg in chunk:
+            offset = reg.addr - start_addr
+            reg_data[ offset:(offset+reg.word_length) ] = reg.encode()
+
+        # in case a register returned too much data
+        assert len(reg_data) == end_addr-start_addr          
+
+        # check for holes (if reg_list_to_chunks malfunctioned)
+        # or if there was a struct register with a hole in the middle
+        if None in reg_data:
+            raise IndexError("write_regs() cannot write a chunk of registers with a hole in it, as that would overwrite an unknown register")
+
+        # values were set locally, the device may not accept them, so decode them again on next read
+        self.invalidate_raw( [ reg for reg_start_addr, reg_end_addr, reg in chunk ] )
+        return reg_data
+
+    async def write_read_regs( self, write_list, read_list, retries=None, priority=PRIORITY_CONTROL ):
+        """
+            Writes registers, then reads registers, for the write-then-verify pattern.
+            Returns the list of registers read, like read_regs().
+
+            If the device supports function code 23 (read/write multiple registers), the last holding
+            register chunk to write and the first holding register chunk to read are done in one single
+            transaction, which saves a round trip. All writes still happen before all reads.
+            Otherwise, this is write_regs() followed by read_regs().
+
+            Args:
+                write_list: list of RegBase instances, or a WritePlan
+                read_list:  list of RegBase instances, or a ReadPlan
+        """
+        if self.support_fcode23:
+            write_plan = self.get_write_plan( write_list )
+            read_plan  = self.get_read_plan( read_list )
+            write_chunks = [ c for c in write_plan.chunks if c[0] == 3 ]
+            read_chunks  = [ c for c in read_plan.chunks  if c[0] == 3 ]
+        if not (self.support_fcode23 and write_chunks and read_chunks):
+            await self.write_regs( write_list, retries, priority )
+            return await self.read_regs( read_list, retries, priority=priority )
+
+        fcode, write_chunk, decoder = write_chunks[-1]
+        fcode, read_chunk, decoder  = read_chunks[0]
+        if other_writes := [ reg for fc, chunk, d in write_plan.chunks if chunk is not write_chunk for s, e, reg in chunk ]:
+            await self.write_regs( other_writes, retries, priority )
+
+        retries = retries or self.default_retries
+        old_is_online = self.is_online
+        try:
+            start_time = time.monotonic()
+            write_addr = write_chunk[0][0]
+            read_addr  = read_chunk[0][0]
+            reg_data   = await self._retry( "write/read", retries, old_is_online, self._write_read_chunk,
+                                    read_addr, read_chunk[-1][1]-read_addr, write_addr, self._encode_chunk( write_chunk ), priority )
+            result = self._decode_update_list( [(fcode, read_chunk, decoder, read_addr, reg_data)], old_is_online )
+        except Exception as e:
+            self.is_online = False
+            raise
+        finally:
+            self._set_timings( start_time )
+
+        if other_reads := [ reg for fc, chunk, d in read_plan.chunks if chunk is not read_chunk for s, e, reg in chunk ]:
+            result.extend( await self.read_regs( other_reads, retries, priority=priority ))
+        return result
+
+    async def _write_read_chunk( self, read_addr, read_count, write_addr, write_data, priority ):
+        """
+            One fcode 23 transaction: writes, then reads holding registers. Returns the list of words read.
+        """
+        async with self.bus.transaction( priority ):
+            t = time.monotonic()
+            resp = await self.modbus.readwrite_registers( read_addr, read_count, write_addr, None, write_data, self.bus_address,
+                                                          **self._timeout_arg( 23, read_count+len(write_data) ))
+            self._add_sample( 23, read_count, time.monotonic()-t, len(write_data) )
+        if isinstance( resp, ExceptionResponse ):
+            if resp.exception_code in (2,3):
+                raise IllegalAddress( str( resp ) )
+            raise ModbusException( str( resp ) )
+        return resp.registers
 
     # for debugging
     def dump_all_regs( self, all=False ):
@@ -527,7 +1208,7 @@ if __name__ == "__main__":
     def p( td, regs, max_hole_size ):
         chunkn = [None]*(regs[-1].addr+regs[-1].word_length)
         regn   = list(chunkn)
-        for cn, (fcode, chunk) in enumerate(td.reg_list_to_chunks( regs, max_hole_size )):
+        for cn, (fcode, chunk, decoder) in enumerate(td.reg_list_to_chunks( regs, max_hole_size )):
             print( cn, ":", " ".join( "%d-%d" % (c[0],c[1]) for c in chunk ))
             for reg_start_addr, reg_end_addr, reg in chunk:
                 for o in range(reg.word_length):
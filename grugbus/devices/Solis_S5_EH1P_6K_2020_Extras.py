@@ -10,7 +10,12 @@ from grugbus import registers
 from . import Solis_S5_EH1P_6K_2020
 
 class U16Bitfield( registers.RegU16, registers.BitfieldMixin ):
-    pass
+    __slots__ = ()
+
+class U16PowerOnOff( registers.RegU16 ):
+    __slots__ = ()
+    value_off = 0xDE
+    value_on  = 0xBE
 
 def MakeRegisters():
     regs = list( Solis_S5_EH1P_6K_2020.MakeRegisters() )
@@ -143,8 +148,8 @@ def MakeRegisters():
     setup_bitfield( "energy_storage_mode", storage_bits )
     setup_bitfield( "rwr_energy_storage_mode", storage_bits )
 
-    r["rwr_power_on_off"].value_off = 0xDE
-    r["rwr_power_on_off"].value_on  = 0xBE
+    # registers have __slots__, so values are in the class
+    r["rwr_power_on_off"].__class__ = U16PowerOnOff
 
     return regs
 
@@ -0,0 +1,215 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+    Modbus gateway serving our devices to other masters.
+
+    An RS485 bus can only have one master, so other tools (Home Assistant, scripts...) can't
+    talk to devices we poll. This is a Modbus server on a TCP port that answers requests for
+    these devices:
+
+        -   Reads are served from register values we already have, if they are younger than
+            max_age, otherwise with read_regs(). Since concurrent reads are coalesced, any number
+            of clients can be served with the same bus traffic as one.
+        -   Writes go through write_regs(), so they are queued on the bus with everything else.
+
+    Requests are mapped to registers: words not belonging to a register read as zero, a read
+    with no register in its range, or a write that does not cover whole registers is answered
+    with exception 2 (illegal data address). If the device does not answer, the response is
+    exception 11 (gateway target failed to respond).
+
+    Values are encoded from reg.value, so they are what the application sees.
+
+        gw = grugbus.gateway.Gateway( [meter, inverter], max_age=1.0 )
+        await gw.serve( 5020 )              # Modbus TCP
+        await gw.serve( 5021, framer="rtu" )  # RTU frames over TCP
+
+    pymodbus servers can't be used for this, since their datastore callbacks can't await.
+"""
+
+import asyncio, struct, time, logging
+from asyncio.exceptions import TimeoutError
+from pymodbus.exceptions import ModbusException, ConnectionException
+from .device import IllegalAddress
+from .bus import PRIORITY_BULK
+from .tcp import _pack_bits, _unpack_bits
+from .rtu import crc16, _frame
+
+log = logging.getLogger(__name__)
+
+# Modbus exception codes
+ILLEGAL_FUNCTION     = 1
+ILLEGAL_ADDRESS      = 2
+ILLEGAL_VALUE        = 3
+DEVICE_FAILURE       = 4
+GATEWAY_PATH         = 10   # no device with this address
+GATEWAY_NO_RESPONSE  = 11
+
+# function code: (read function code of the registers, maximum count)
+_READ_FCODES  = { 1:(1,2000), 2:(2,2000), 3:(3,125), 4:(4,125) }
+_WRITE_FCODES = { 5:1, 6:3, 15:1, 16:3 }
+
+class Gateway:
+    def __init__( self, devices, max_age=1.0, priority=PRIORITY_BULK ):
+        """
+            :param  devices:    list of SlaveDevice served at their bus_address,
+                                or dict of { address: SlaveDevice }
+            :param  max_age:    register values younger than this are served without reading the device
+            :param  priority:   bus priority of reads and writes made for clients
+        """
+        if not isinstance( devices, dict ):
+            d = {}
+            for device in devices:
+                if device.bus_address in d:
+                    raise ValueError( "Gateway: %s and %s have the same address %d" % (d[device.bus_address].key, device.key, device.bus_address) )
+                d[ device.bus_address ] = device
+            devices = d
+        self.devices  = devices
+        self.max_age  = max_age
+        self.priority = priority
+        self.request_count = 0
+
+    async def serve( self, port, host="0.0.0.0", framer="tcp" ):
+        """
+            Serves requests until cancelled.
+            framer is "tcp" for Modbus TCP, or "rtu" for RTU frames over TCP.
+        """
+        handler = { "tcp":self._handle_tcp, "rtu":self._handle_rtu }[ framer ]
+        server = await asyncio.start_server( handler, host, port )
+        log.info( "Gateway: serving %s on port %d (%s)", ", ".join( d.key for d in self.devices.values() ), port, framer )
+        async with server:
+            await server.serve_forever()
+
+    async def _handle_tcp( self, reader, writer ):
+        try:
+            while True:
+                header = await reader.readexactly( 7 )
+                tid, pid, length, unit = struct.unpack( ">HHHB", header )
+                if length < 2 or length > 254:
+                    break
+                pdu = await reader.readexactly( length-1 )
+                resp = await self.execute( unit, pdu )
+                writer.write( struct.pack( ">HHHB", tid, pid, len(resp)+1, unit ) + resp )
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _handle_rtu( self, reader, writer ):
+        try:
+            while True:
+                head = await reader.readexactly( 2 )
+                fcode = head[1]
+                if fcode in _READ_FCODES or fcode in (5,6):
+                    frame = head + await reader.readexactly( 6 )
+                elif fcode in (15,16):
+                    frame = head + await reader.readexactly( 5 )
+                    frame += await reader.readexactly( frame[6] + 2 )
+                else:
+                    break   # can't find the end of the frame
+                if crc16( frame ):
+                    log.info( "Gateway: bad CRC from %s", writer.get_extra_info( "peername" ))
+                    break
+                resp = await self.execute( frame[0], frame[1:-2] )
+                writer.write( _frame( frame[0], resp ))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def execute( self, address, pdu ):
+        """
+            Returns the response PDU to a request PDU for the device at this address
+        """
+        self.request_count += 1
+        fcode = pdu[0]
+        device = self.devices.get( address )
+        if device is None:
+            return bytes(( fcode | 0x80, GATEWAY_PATH ))
+        try:
+            if fcode in _READ_FCODES:
+                return await self._read( device, fcode, pdu )
+            if fcode in _WRITE_FCODES:
+                return await self._write( device, fcode, pdu )
+            return bytes(( fcode | 0x80, ILLEGAL_FUNCTION ))
+        except IllegalAddress:
+            return bytes(( fcode | 0x80, ILLEGAL_ADDRESS ))
+        except (TimeoutError, ModbusException, ConnectionException) as e:
+            log.info( "Gateway: %s: %s", device.key, e )
+            return bytes(( fcode | 0x80, GATEWAY_NO_RESPONSE ))
+        except (struct.error, ValueError, OverflowError):
+            return bytes(( fcode | 0x80, ILLEGAL_VALUE ))
+
+    async def _read( self, device, fcode, pdu ):
+        reg_fcode, max_count = _READ_FCODES[ fcode ]
+        start, count = struct.unpack_from( ">HH", pdu, 1 )
+        if not 1 <= count <= max_count:
+            return bytes(( fcode | 0x80, ILLEGAL_VALUE ))
+        regs = device.addr_index.regs_in_range( reg_fcode, start, start+count )
+        if not regs:
+            return bytes(( fcode | 0x80, ILLEGAL_ADDRESS ))
+
+        t = time.monotonic() - self.max_age
+        await device.read_regs( regs, max_age=self.max_age, priority=self.priority )
+        if any( reg.timestamp < t for reg in regs ):
+            return bytes(( fcode | 0x80, GATEWAY_NO_RESPONSE ))    # read failed
+
+        data = [0] * count
+        for reg in regs:
+            if reg.value is not None:   # None for NaN floats, served as zero
+                offset = reg.addr - start
+                data[ offset:offset+reg.word_length ] = reg.encode()
+        if fcode <= 2:
+            data = _pack_bits( data )
+            return struct.pack( ">BB", fcode, len(data) ) + data
+        return struct.pack( ">BB%dH" % count, fcode, 2*count, *data )
+
+    async def _write( self, device, fcode, pdu ):
+        reg_fcode = _WRITE_FCODES[ fcode ]
+        if fcode == 5:
+            start, value = struct.unpack_from( ">HH", pdu, 1 )
+            if value not in (0, 0xFF00):
+                return bytes(( fcode | 0x80, ILLEGAL_VALUE ))
+            data = [ bool( value ) ]
+        elif fcode == 6:
+            start, value = struct.unpack_from( ">HH", pdu, 1 )
+            data = [ value ]
+        else:
+            start, count, nbytes = struct.unpack_from( ">HHB", pdu, 1 )
+            if fcode == 15:
+                data = _unpack_bits( pdu[6:6+nbytes] )[ :count ]
+            else:
+                data = list( struct.unpack_from( ">%dH" % count, pdu, 6 ))
+            if len( data ) != count:
+                return bytes(( fcode | 0x80, ILLEGAL_VALUE ))
+
+        # the write must cover whole writable registers, without holes
+        end = start + len( data )
+        regs = device.addr_index.regs_in_range( reg_fcode, start, end )
+        addr = start
+        for reg in regs:
+            if reg.addr != addr or fcode not in reg.fcodes:
+                break
+            addr += reg.word_length
+        if not regs or addr != end:
+            return bytes(( fcode | 0x80, ILLEGAL_ADDRESS ))
+
+        # write_regs() encodes reg.value, so decode the request into it, but put the old values
+        # back if the write fails, so the application does not see values the device never took
+        old = [ (reg.value, reg.raw_value) for reg in regs ]
+        try:
+            for reg in regs:
+                offset = reg.addr - start
+                reg.decode( reg_fcode, data[ offset:offset+reg.word_length ] )
+            await device.write_regs( regs, priority=self.priority )
+        except BaseException:
+            for reg, (value, raw_value) in zip( regs, old ):
+                reg.value     = value
+                reg.raw_value = raw_value
+            raise
+
+        if fcode in (5,6):
+            return bytes( pdu[:5] )     # echo of the request
+        return struct.pack( ">BHH", fcode, start, len( data ))
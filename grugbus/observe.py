@@ -0,0 +1,81 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import asyncio, logging
+
+log = logging.getLogger(__name__)
+
+class Observer:
+    """
+        Notification when register values change, see DeviceBase.observe().
+
+        After each read, registers whose value moved by more than the deadband since the last
+        notification are delivered as one list, right where read_regs() assigns values, without
+        any await in between, so all values in the list come from the same read.
+
+        Either with a callback, which must not block:
+
+            device.observe( [device.total_power, device.frequency], callback, deadband=10 )
+
+        Or as an async iterator, which merges notifications if the consumer is slower than reads:
+
+            async for regs in device.observe( [device.total_power] ):
+                ...
+    """
+    def __init__( self, regs, callback=None, deadband=0 ):
+        """
+            :param  deadband:   minimum change to notify, or dict of { reg: deadband }.
+                                Values that are not numbers are notified on any change.
+                                None to notify all registers read, even if they did not change.
+        """
+        self.regs     = tuple( regs )
+        self.callback = callback
+        if deadband is None:
+            self.deadband = None
+        elif isinstance( deadband, dict ):
+            self.deadband = { reg: deadband.get( reg, 0 ) for reg in self.regs }
+        else:
+            self.deadband = { reg: deadband for reg in self.regs }
+        self.last     = {}      # reg: value at last notification
+        self.pending  = {}      # registers not taken by the async iterator yet, in order
+        self.event    = asyncio.Event()
+
+    def _changed( self, reg ):
+        value = reg.value
+        if reg not in self.last:
+            return True
+        last = self.last[ reg ]
+        if isinstance( value, (int, float) ) and isinstance( last, (int, float) ):
+            return abs( value - last ) > self.deadband[ reg ]
+        return value != last
+
+    def update( self, regs ):
+        """
+            Called by the device with registers just decoded, which are all observed by this.
+        """
+        if self.deadband is None:
+            changed = regs
+        else:
+            changed = [ reg for reg in regs if self._changed( reg ) ]
+        if not changed:
+            return
+        for reg in changed:
+            self.last[ reg ] = reg.value
+            self.pending[ reg ] = None
+        self.event.set()
+        if self.callback:
+            try:
+                self.callback( changed )
+            except Exception:
+                log.exception( "Observer callback" )
+
+    def __aiter__( self ):
+        return self
+
+    async def __anext__( self ):
+        while not self.pending:
+            self.event.clear()
+            await self.event.wait()
+        regs = list( self.pending )
+        self.pending.clear()
+        return regs
@@ -0,0 +1,211 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import collections, math, bisect
+
+class Plan:
+    """
+        Precompiled list of modbus transactions for a set of registers.
+
+        Converting a register list into chunks (and compiling the chunk decoders)
+        is done once. Build a plan with SlaveDevice.make_read_plan() or make_write_plan(),
+        then pass it to read_regs()/write_regs() instead of a register list:
+        this skips planning and the plan cache lookup, which has to hash the register list.
+
+        chunks is a list of (fcode, [(reg_start_addr, reg_end_addr, reg), ...], decoder)
+        decoder is a ChunkDecoder compiled for this chunk, or None if it should be decoded register by register.
+    """
+    __slots__ = "regs", "chunks", "max_hole_size"
+
+    def __init__( self, regs, chunks, max_hole_size ):
+        self.regs          = regs
+        self.chunks        = chunks
+        self.max_hole_size = max_hole_size
+
+class ReadPlan( Plan ):
+    __slots__ = ()
+
+class WritePlan( Plan ):
+    __slots__ = ()
+
+class PlanCache:
+    """
+        LRU cache for plans, so callers passing register lists don't have to re-plan every time.
+
+        Key is built from a frozenset of registers, so it doesn't depend on the order of
+        registers in the list, or on the list being rebuilt by the caller.
+        Unlike functools.cache, size is bounded, and it does not keep the device alive.
+    """
+    def __init__( self, maxsize ):
+        self.maxsize   = maxsize
+        self.plans     = collections.OrderedDict()
+        self.hits      = 0
+        self.misses    = 0
+        self.evictions = 0
+        self.generation = 0     # incremented by clear(), so holders of plans can tell they are stale
+
+    def get( self, key ):
+        plan = self.plans.get( key )
+        if plan is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.plans.move_to_end( key )
+        return plan
+
+    def put( self, key, plan ):
+        self.plans[ key ] = plan
+        if len( self.plans ) > self.maxsize:
+            self.plans.popitem( last=False )
+            self.evictions += 1
+        return plan
+
+    def clear( self ):
+        self.plans.clear()
+        self.generation += 1
+
+    def stats( self ):
+        return { "size":len( self.plans ), "hits":self.hits, "misses":self.misses, "evictions":self.evictions }
+
+class AddressIndex:
+    """
+        Registers sorted by address for each function code, to find registers containing
+        an address, or inside an address range, by bisection.
+    """
+    def __init__( self ):
+        self.starts = {}    # fcode: sorted list of register start addresses
+        self.regs   = {}    # fcode: registers, in the same order
+
+    def add( self, fcode, reg ):
+        """
+            Raises KeyError if reg overlaps another register
+        """
+        starts = self.starts.setdefault( fcode, [] )
+        regs   = self.regs.setdefault( fcode, [] )
+        i = bisect.bisect_left( starts, reg.addr )
+        # registers already in the index don't overlap, so only neighbors can overlap reg
+        for other in regs[ max( i-1, 0 ):i+1 ]:
+            if other.addr < reg.addr+reg.word_length and reg.addr < other.addr+other.word_length:
+                raise KeyError( "Registers %s and %s overlap, wrong register definition?" % (reg.key, other.key) )
+        starts.insert( i, reg.addr )
+        regs.insert( i, reg )
+
+    def get( self, fcode, addr ):
+        """
+            Returns the register containing this address, or None
+        """
+        if starts := self.starts.get( fcode ):
+            i = bisect.bisect_right( starts, addr ) - 1
+            if i >= 0:
+                reg = self.regs[fcode][i]
+                if addr < reg.addr+reg.word_length:
+                    return reg
+
+    def regs_in_range( self, fcode, start_addr, end_addr ):
+        """
+            Returns registers fully contained in [start_addr, end_addr[, sorted by address
+        """
+        starts = self.starts.get( fcode )
+        if not starts:
+            return []
+        i = bisect.bisect_left( starts, start_addr )
+        j = bisect.bisect_left( starts, end_addr )
+        return [ reg for reg in self.regs[fcode][i:j] if reg.addr+reg.word_length <= end_addr ]
+
+class CostModel:
+    """
+        Estimated bus time of a modbus transaction, used by plan_chunks() to decide
+        if it is faster to read a hole between registers, or issue another transaction.
+
+        cost = overhead + words*word_time
+
+        overhead:   request frame, response header, silent intervals between frames, and turnaround
+                    (device response time plus our own processing time)
+        word_time:  time to transfer one more register on the wire
+        bit_time:   same for coils and discrete inputs
+    """
+    def __init__( self, overhead, word_time, bit_time=None ):
+        self.overhead  = overhead
+        self.word_time = word_time
+        self.bit_time  = word_time/16 if bit_time is None else bit_time
+
+    @classmethod
+    def from_serial( cls, baudrate, bytesize=8, parity="N", stopbits=1, turnaround=0.02 ):
+        """
+            Modbus RTU: each byte is sent with start, parity and stop bits.
+            Read request is 8 bytes, response is 5 bytes plus data, and each frame
+            is followed by 3.5 characters of silence.
+        """
+        char_time = (1 + bytesize + (parity != "N") + stopbits) / baudrate
+        return cls( (8 + 5 + 2*3.5)*char_time + turnaround, 2*char_time, char_time/8 )
+
+    @classmethod
+    def from_client( cls, modbus, turnaround=0.02, **kwargs ):
+        """
+            Derives the cost model from the pymodbus client's serial settings,
+            which come from the SERIAL sections in config.py.
+            kwargs override overhead, word_time and bit_time
+        """
+        p = getattr( modbus, "comm_params", None )
+        if baudrate := getattr( p, "baudrate", None ):
+            m = cls.from_serial( baudrate, p.bytesize or 8, p.parity or "N", p.stopbits or 1, turnaround )
+        else:
+            # Modbus TCP or unknown client: transaction time is dominated by latency
+            m = cls( turnaround, 0.0001 )
+        for k, v in kwargs.items():
+            setattr( m, k, v )
+        return m
+
+    def cost( self, fcode, length ):
+        if fcode in (1,2,5,15):
+            return self.overhead + length*self.bit_time
+        return self.overhead + length*self.word_time
+
+    def __repr__( self ):
+        return "CostModel( overhead=%.04fs, word_time=%.05fs, bit_time=%.06fs )" % (self.overhead, self.word_time, self.bit_time)
+
+def plan_chunks( addrs, cost, max_chunk, max_hole_size=None, readable=None ):
+    """
+        Splits a list of registers into chunks, minimizing total bus time according to cost().
+        This is dynamic programming over sorted addresses: best[i] is the cost of the best
+        plan for the first i registers, which is the best plan for the first j registers
+        plus one transaction for registers j..i-1, for all j where it fits into max_chunk.
+
+        addrs:          list of (reg_start_addr, reg_end_addr, reg) sorted by address
+        cost:           function( length in words ) returning the cost of one transaction
+        max_chunk:      maximum length of a transaction
+        max_hole_size:  if not None, also forbid holes larger than this in a chunk
+        readable:       if not None, function( start_addr, end_addr ) returning False if
+                        this hole can't be read, which also splits the chunk
+
+        Returns list of chunks, each chunk being a slice of addrs.
+    """
+    n    = len(addrs)
+    best = [0.0] + [math.inf]*n
+    prev = [0]*(n+1)
+    for i in range( 1, n+1 ):
+        end_addr = addrs[i-1][1]
+        for j in range( i-1, -1, -1 ):
+            start_addr = addrs[j][0]
+            if j < i-1:     # a register longer than max_chunk still gets a chunk of its own
+                if end_addr - start_addr > max_chunk:
+                    break
+                hole_start = addrs[j][1]
+                hole_end   = addrs[j+1][0]
+                if max_hole_size is not None and hole_end - hole_start > max_hole_size:
+                    break
+                if readable and hole_start < hole_end and not readable( hole_start, hole_end ):
+                    break
+            c = best[j] + cost( end_addr - start_addr )
+            if c < best[i]:
+                best[i] = c
+                prev[i] = j
+
+    chunks = []
+    i = n
+    while i:
+        j = prev[i]
+        chunks.append( addrs[j:i] )
+        i = j
+    chunks.reverse()
+    return chunks
@@ -0,0 +1,145 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+    Device capability probing.
+
+    Datasheets don't say how many registers can be read in one command, and many devices
+    answer "illegal address" if a bulk read goes through an undocumented address, which
+    fails the whole read. This finds out, for each function code used by the device registers:
+
+        -   Which address ranges can be read (registers, and holes between them)
+        -   The maximum number of registers in one read command
+
+    The result is saved as a JSON profile next to the device module, and loaded by
+    passing profile=grugbus.probe.profile_path( module ) to the device constructor.
+
+    Usage:
+        python -m grugbus.probe <device module> <serial port> <baudrate> <modbus address>
+
+    Example:
+        python -m grugbus.probe Solis_S5_EH1P_6K_2020_Extras /dev/ttyUSB0 9600 1
+"""
+
+import os, sys, json, asyncio, logging, importlib
+from asyncio.exceptions import TimeoutError
+from pymodbus.exceptions import ModbusException, ConnectionException
+
+log = logging.getLogger(__name__)
+
+# Modbus spec limits
+PROTOCOL_MAX_COUNT = { 1:2000, 2:2000, 3:125, 4:125 }
+
+def profile_path( module ):
+    """
+        Returns the profile path for a device module, like devices/Eastron_SDM120.profile.json
+    """
+    return os.path.splitext( module.__file__ )[0] + ".profile.json"
+
+def save_profile( path, profile ):
+    with open( path, "w" ) as f:
+        json.dump( profile, f, indent=4 )
+
+async def _can_read( device, fcode, start_addr, end_addr ):
+    await device.connect()
+    try:
+        await device._read_chunk( fcode, start_addr, end_addr-start_addr )
+        return True
+    except (TimeoutError,ModbusException,ConnectionException) as e:
+        # Some devices answer with an exception, some don't answer at all
+        log.debug( "%s: probe %d [%d,%d[: %s", device.key, fcode, start_addr, end_addr, e )
+        return False
+
+async def _probe_range( device, fcode, start_addr, end_addr, max_count, result ):
+    """
+        Bisects [start_addr,end_addr[ and appends readable ranges to result
+    """
+    if end_addr - start_addr <= max_count and await _can_read( device, fcode, start_addr, end_addr ):
+        result.append( [start_addr, end_addr] )
+    elif end_addr - start_addr > 1:
+        mid = (start_addr + end_addr) // 2
+        await _probe_range( device, fcode, start_addr, mid, max_count, result )
+        await _probe_range( device, fcode, mid, end_addr, max_count, result )
+
+def _merge( ranges ):
+    result = []
+    for start_addr, end_addr in sorted( ranges ):
+        if result and result[-1][1] == start_addr:
+            result[-1][1] = end_addr
+        else:
+            result.append( [start_addr, end_addr] )
+    return result
+
+async def probe( device, fcodes=None, max_count=None ):
+    """
+        Probes a SlaveDevice and returns its profile, see DeviceBase.apply_profile().
+
+        Only addresses near the device's registers are probed: registers, and holes shorter than
+        the maximum read length. Addresses beyond that are left out of readable ranges, so the
+        profile marks them unreadable, which is fine since they would not fit in one read anyway.
+
+        fcodes:     list of function codes to probe, default is all read function codes used by registers
+        max_count:  maximum read length to try, default is the modbus spec limit
+    """
+    if fcodes is None:
+        fcodes = sorted({ reg.fcodes[0] for reg in device.registers if hasattr( reg, "addr" ) and reg.fcodes[0] in PROTOCOL_MAX_COUNT })
+
+    profile = { "max_regs_in_command":{}, "readable":{} }
+    for fcode in fcodes:
+        limit = min( max_count or PROTOCOL_MAX_COUNT[fcode], PROTOCOL_MAX_COUNT[fcode] )
+
+        # address spans to probe: registers, and holes between them that could fit in a read
+        spans = []
+        for start_addr, end_addr in sorted( (reg.addr, reg.addr+reg.word_length) for reg in device.registers
+                                            if hasattr( reg, "addr" ) and reg.fcodes[0] == fcode ):
+            if spans and start_addr - spans[-1][1] < limit:
+                spans[-1][1] = max( spans[-1][1], end_addr )
+            else:
+                spans.append( [start_addr, end_addr] )
+
+        readable = []
+        for start_addr, end_addr in spans:
+            await _probe_range( device, fcode, start_addr, end_addr, limit, readable )
+        readable = _merge( readable )
+        log.info( "%s: fcode %d readable ranges: %s", device.key, fcode, readable )
+
+        # Maximum read length: bisect inside the longest readable range, so failures can only be caused by length
+        count = 0
+        if readable:
+            start_addr, end_addr = max( readable, key=lambda r: r[1]-r[0] )
+            lo = 1
+            hi = min( end_addr-start_addr, limit )
+            if await _can_read( device, fcode, start_addr, start_addr+hi ):
+                # Read plans can't go through unreadable addresses, so they can't be longer than this anyway
+                count = limit
+            else:
+                while hi - lo > 1:
+                    mid = (lo+hi) // 2
+                    if await _can_read( device, fcode, start_addr, start_addr+mid ):
+                        lo = mid
+                    else:
+                        hi = mid
+                count = lo
+        log.info( "%s: fcode %d max registers in command: %d", device.key, fcode, count )
+
+        profile["max_regs_in_command"][fcode] = count
+        profile["readable"][fcode]            = readable
+    return profile
+
+async def main( module_name, port, baudrate, bus_address ):
+    from pymodbus.client import AsyncModbusSerialClient
+    from .device import SlaveDevice
+    module = importlib.import_module( "grugbus.devices." + module_name )
+    modbus = AsyncModbusSerialClient( port=port, baudrate=baudrate, timeout=0.5, retries=0, bytesize=8, parity="N", stopbits=1 )
+    device = SlaveDevice( modbus, bus_address, module_name, module_name, module.MakeRegisters() )
+    await device.connect()
+    path = profile_path( module )
+    save_profile( path, await probe( device ))
+    print( "Saved", path )
+
+if __name__ == "__main__":
+    logging.basicConfig( level=logging.INFO )
+    if len( sys.argv ) != 5:
+        print( "Usage: python -m grugbus.probe <device module> <serial port> <baudrate> <modbus address>" )
+        sys.exit( 1 )
+    asyncio.run( main( sys.argv[1], sys.argv[2], int(sys.argv[3]), int(sys.argv[4]) ))
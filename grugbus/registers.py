@@ -1,7 +1,31 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
-import struct, datetime, math
+import struct, datetime, math, operator
+
+# numpy is optional, it is only used by NumpyChunkDecoder
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#
+#   Value formatters for MQTT, shared between all registers with the same number of decimals,
+#   instead of creating two lambdas per register instance.
+#
+_float_formatters = {}
+
+def get_float_formatter( decimals ):
+    try:
+        return _float_formatters[ decimals ]
+    except KeyError:
+        format_value_fstr = "%%.0%df" % max( decimals, 1 )
+        # adding 0.0 converts -0.0 into 0.0
+        f = _float_formatters[ decimals ] = lambda v: format_value_fstr % (0.0 + round( v, decimals ))
+        return f
+
+def format_int( v ):
+    return "%d"%v
 
 class RegBase( ):
     """
@@ -51,7 +75,16 @@ class RegBase( ):
         See DeviceBase() for bulk read/writes.
 
         See code below for rest of documentation.
+
+        Registers use __slots__ since there are hundreds of them per device.
     """
+    __slots__ = (   "fcodes", "device", "addr", "nvalues", "key", "unit_value", "unit", "name", "description",
+                    "little_endian", "swap_words", "user_type", "decimals", "_format_value",
+                    "word_length", "_post_decode", "_pre_encode", "_set_raw_value",
+                    "value", "raw_value", "timestamp", "changed",
+                    "bits",     # for BitfieldMixin
+                )
+
     def __init__( self, 
         fcodes,
         addr        : int,
@@ -116,10 +149,7 @@ Args:
                 self.decimals = -round(math.log10(abs(self.unit_value)))
             else:
                 self.decimals = int(decimals)
-            format_value_fstr = "%%.0%df" % max( self.decimals, 1 )
-            # adding 0.0 converts -0.0 into 0.0
-            self._format_value = lambda v: format_value_fstr % (0.0 + round( v, self.decimals ))
-            self.format_value = lambda: format_value_fstr % (0.0 + round( self.value, self.decimals ))
+            self._format_value = get_float_formatter( self.decimals )
 
         else:
             if decimals not in (0,None):
@@ -128,30 +158,35 @@ Args:
             if self.unit_value not in (1,-1):
                 raise ValueError( "%s: user_type <%s> requires unit_value=1 or -1 (integer)" % (self.key,user_type,))
             self.unit_value = int(self.unit_value)     # cast unit_value to int  to make sure self.value will always be an int
-            self._format_value = lambda v: "%d"%v
-            self.format_value = lambda: "%d"%self.value
+            self._format_value = format_int
 
         # derived classes initialization
         self._init2()
 
         #   quick member functions to avoid if's everywhere.
+        #   derived classes customize them by overriding the _single and _array versions
         if self.nvalues == 1:   #   This register contains one single value
-            if not hasattr( self, "_post_decode"   ): self._post_decode   = self._post_decode_single
-            if not hasattr( self, "_pre_encode"    ): self._pre_encode    = self._pre_encode_single
-            if not hasattr( self, "_set_raw_value" ): self._set_raw_value = self._set_raw_value_single
+            self._post_decode   = self._post_decode_single
+            self._pre_encode    = self._pre_encode_single
+            self._set_raw_value = self._set_raw_value_single
         else:                   #   It contains an array, so use appropriate functions
-            if not hasattr( self, "_post_decode"   ): self._post_decode   = self._post_decode_array
-            if not hasattr( self, "_pre_encode"    ): self._pre_encode    = self._pre_encode_array
-            if not hasattr( self, "_set_raw_value" ): self._set_raw_value = self._set_raw_value_array
+            self._post_decode   = self._post_decode_array
+            self._pre_encode    = self._pre_encode_array
+            self._set_raw_value = self._set_raw_value_array
 
         # These will be updated on read()
         self.value      = None  # value after scale and unit conversion
         self.raw_value  = None  # raw value as seen on bus
+        self.timestamp  = 0     # time.monotonic() of last successful read, for read( max_age )
+        self.changed    = True  # False if the last read returned the same raw words, see DeviceBase skip_unchanged
 
     # Must be overriden
     def _init2( self ):
         raise NotImplementedError
 
+    def format_value( self ):
+        return self._format_value( self.value )
+
     def set_device( self, device ):
         self.device = device
 
@@ -164,13 +199,14 @@ Args:
     #   Not used when *WE* are the server
     ########################################################
 
-    async def read( self ):
+    async def read( self, max_age=None ):
         """
         Reads this register from the remote server. 
         This requires this object to be linked to the device it is physically in via DeviceBase::__init__()
+        If max_age is not None and the value was read less than max_age seconds ago, it is not read again.
         """
         # Use the range read operation to read this register, to avoid code duplication
-        await self.device.read_regs( (self,) )
+        await self.device.read_regs( (self,), max_age=max_age )
         return self.value
 
     async def write( self, value=None ):
@@ -264,6 +300,8 @@ class RegBool( RegBase ):
     """
         Boolean register, could be a coil or a discrete input
     """
+    __slots__ = ()
+
     def _init2( self ):
         # for bool registers, one word is still one register (one bit)
         self.word_length  = self.nvalues
@@ -302,11 +340,14 @@ class Reg16( RegBase ):
     """
         Base class for word-based (16 bit and 32 bit) registers (holding and input regs)
     """
+    __slots__ = "byte_length", "_struct_chunk_code", "_struct_decode_unpack", "_struct_decode_pack"
 
     def _init2( self ):
         # make struct codes for conversion between wire data and python data
         # see decode() for how it's used
-        self._struct_decode_unpack = ("<" if self.little_endian else ">") + self.nvalues*self._struct_decode_unpack
+        # _struct_chunk_code has no byte order prefix, it is used by ChunkDecoder to build a struct for the whole chunk
+        self._struct_chunk_code    = self.nvalues*self._struct_code
+        self._struct_decode_unpack = ("<" if self.little_endian else ">") + self._struct_chunk_code
         self.byte_length  = struct.calcsize( self._struct_decode_unpack )
         self.word_length  = self.byte_length //2
         self._struct_decode_pack = ">" + self.word_length*"H"
@@ -340,6 +381,8 @@ class Reg16( RegBase ):
         return struct.unpack( self._struct_decode_pack, struct.pack( self._struct_decode_unpack, *self._pre_encode() ))
         
 class Reg32( Reg16 ):
+    __slots__ = ()
+
     def decode( self, fcode, data ):
         """
         Args:
@@ -372,18 +415,23 @@ class Reg32( Reg16 ):
 
 #
 #   Only difference between signed and unsigned is the struct code
+#   (class attribute, the instance slots hold the complete struct formats)
 #
 class RegU16( Reg16 ):
-    _struct_decode_unpack = "H"
+    __slots__ = ()
+    _struct_code = "H"
 
 class RegS16( Reg16 ):
-    _struct_decode_unpack = "h"
+    __slots__ = ()
+    _struct_code = "h"
 
 class RegU32( Reg32 ):
-    _struct_decode_unpack = "L"
+    __slots__ = ()
+    _struct_code = "L"
 
 class RegS32( Reg32 ):
-    _struct_decode_unpack = "l"
+    __slots__ = ()
+    _struct_code = "l"
 
 ########################################################
 #   Floats
@@ -397,7 +445,8 @@ class RegFloat( Reg32 ):
         If the register is fixed point, you need an integer register
         with a unit scale factor instead.
     """
-    _struct_decode_unpack = "f"
+    __slots__ = ()
+    _struct_code = "f"
 
     def _init2( self ):
         super()._init2()
@@ -427,11 +476,173 @@ class RegFloat( Reg32 ):
         self.value = v = [ self.nonan(v) for v in x ]  # unit_value is int or float depending on user_type, to return proper type to user
         return v
 
+########################################################
+#   Chunk decoder
+########################################################
+
+class ChunkDecoder:
+    """
+        Decodes all registers in a bulk read chunk at once.
+
+        Calling decode() on each register means one struct.pack() and one struct.unpack()
+        per register, plus the word swapping loop for Reg32. Instead, this builds a struct
+        for the whole chunk once, when the chunk is planned, so the wire data is converted
+        into all the typed values in one call:
+
+        - itemgetter picks the words belonging to registers, swapping words if required
+        - one struct packs them into bytes
+        - one struct unpacks them into typed values, with padding for holes
+
+        Then each register only applies its unit_value via _post_decode().
+
+        Registers that can't be handled this way (bools, structs, registers with a byte
+        order different from the rest of the chunk) are decoded the usual way.
+    """
+    def __init__( self, fcode, chunk ):
+        """
+        Args:
+            fcode:  function code used to read this chunk
+            chunk:  list of (reg_start_addr, reg_end_addr, reg) sorted by address, as produced by reg_list_to_chunks()
+        """
+        self.fcode      = fcode
+        self.start_addr = start_addr = chunk[0][0]
+        self._regs      = []        # (reg, offset into unpacked values, nvalues)
+        self._fallback  = []        # (reg, offset into wire data) for registers decoded with reg.decode()
+
+        byte_order = None
+        codes      = []
+        words      = []             # index of each word to pack, in wire data
+        addr       = start_addr     # end of previous register handled by struct
+        nvalues    = 0
+        for reg_start_addr, reg_end_addr, reg in chunk:
+            assert fcode in reg.fcodes
+            if isinstance( reg, Reg16 ) and reg.addr >= addr:
+                bo = "<" if reg.little_endian else ">"
+                if byte_order is None:
+                    byte_order = bo
+                if bo == byte_order:
+                    if reg.addr > addr:     # hole in the chunk
+                        codes.append( "%dx" % (2*(reg.addr-addr)) )
+                        words.extend( range( addr-start_addr, reg.addr-start_addr ))
+                    offset = reg.addr-start_addr
+                    w = list( range( offset, offset+reg.word_length ))
+                    if reg.swap_words and isinstance( reg, Reg32 ):
+                        w[0::2], w[1::2] = w[1::2], w[0::2]
+                    words.extend( w )
+                    codes.append( reg._struct_chunk_code )
+                    self._regs.append( (reg, nvalues, reg.nvalues) )
+                    nvalues += reg.nvalues
+                    addr = reg.addr+reg.word_length
+                    continue
+            self._fallback.append( (reg, reg.addr-start_addr) )
+
+        if self._regs:
+            self._unpack = struct.Struct( byte_order + "".join( codes )).unpack
+            self._pack   = struct.Struct( ">%dH" % len(words) ).pack
+            if len(words) == 1:     # itemgetter would return a single value, not a tuple
+                self._select = lambda data: data[:1]
+            else:
+                self._select = operator.itemgetter( *words )
+
+    def decode( self, data ):
+        """
+            Decodes wire data for the whole chunk and sets value in all registers.
+        """
+        if self._regs:
+            values = self._unpack( self._pack( *self._select( data )))
+            for reg, offset, nvalues in self._regs:
+                reg._post_decode( values[offset:(offset+nvalues)] )
+
+        fcode = self.fcode
+        for reg, offset in self._fallback:
+            reg.decode( fcode, data[ offset:(offset+reg.word_length) ] )
+
+class NumpyChunkDecoder:
+    """
+        Same as ChunkDecoder, but uses numpy, which is optional.
+
+        The chunk's words are loaded into a big-endian uint16 array. Registers of the same
+        type are gathered into one group per (dtype, value type): words are picked (and swapped)
+        with one fancy index, reinterpreted as >f4, >i4, >u2, etc with view(), and scaled
+        by unit_value in one multiplication. NaN is converted to None in bulk for RegFloat.
+        Then values are written back to the registers.
+
+        This is worth it for large float chunks (the SDM630 map) and array registers,
+        for short chunks ChunkDecoder is faster.
+    """
+    _dtypes = { "H":"u2", "h":"i2", "L":"u4", "l":"i4", "f":"f4" }
+
+    def __init__( self, fcode, chunk ):
+        self.fcode      = fcode
+        self.start_addr = start_addr = chunk[0][0]
+        self._fallback  = []
+        groups = {}
+        addr   = start_addr
+        for reg_start_addr, reg_end_addr, reg in chunk:
+            assert fcode in reg.fcodes
+            if isinstance( reg, Reg16 ) and reg.addr >= addr:
+                dtype = ("<" if reg.little_endian else ">") + self._dtypes[ reg._struct_code ]
+                is_float = isinstance( reg, RegFloat )
+                # group by result type, to return the same types as _post_decode()
+                g = groups.setdefault( (dtype, is_float, isinstance( reg.unit_value, float )), ([], [], []) )
+                words, scale, regs = g
+                offset = reg.addr-start_addr
+                w = list( range( offset, offset+reg.word_length ))
+                if reg.swap_words and isinstance( reg, Reg32 ):
+                    w[0::2], w[1::2] = w[1::2], w[0::2]
+                regs.append( (reg, len(scale), reg.nvalues) )
+                words.extend( w )
+                scale.extend( [reg.unit_value]*reg.nvalues )
+                addr = reg.addr+reg.word_length
+            else:
+                self._fallback.append( (reg, reg.addr-start_addr) )
+
+        self._groups = []
+        for (dtype, is_float, float_scale), (words, scale, regs) in groups.items():
+            self._groups.append((
+                numpy.array( words, dtype=numpy.intp ),
+                numpy.dtype( dtype ),
+                numpy.array( scale, dtype=numpy.float64 if float_scale else numpy.int64 ),
+                is_float,
+                regs ))
+
+    def decode( self, data ):
+        """
+            Decodes wire data for the whole chunk and sets value in all registers.
+        """
+        if self._groups:
+            words = numpy.array( data, dtype=">u2" )
+            for idx, dtype, scale, is_float, regs in self._groups:
+                raw = words[idx].view( dtype )
+                with numpy.errstate( invalid="ignore" ):    # don't warn on signaling NaNs
+                    values = (raw * scale).tolist()
+                if is_float:
+                    # Convert NaN to None
+                    bad = ~numpy.isfinite( raw )
+                    if bad.any():
+                        for n in numpy.flatnonzero( bad ).tolist():
+                            values[n] = None
+                raw = raw.tolist()
+                for reg, offset, nvalues in regs:
+                    if nvalues == 1:
+                        reg.raw_value = raw[offset]
+                        reg.value     = values[offset]
+                    else:
+                        reg.raw_value = tuple( raw[offset:(offset+nvalues)] )
+                        reg.value     = values[offset:(offset+nvalues)]
+
+        fcode = self.fcode
+        for reg, offset in self._fallback:
+            reg.decode( fcode, data[ offset:(offset+reg.word_length) ] )
+
 ########################################################
 #   Bitfield Registers (not finished)
 ########################################################
 
 class BitfieldMixin():
+    # self.bits is a slot in RegBase, so registers can be turned into bitfields by changing their __class__
+    __slots__ = ()
+
     def init_bits_n( self, bits ):
         self.bits = { bit_name:(bit,bool(active_high)) for bit,active_high,bit_name in bits }
         configured_bits = set( bit_bit for (bit_bit,active_high) in self.bits.values() )
@@ -489,6 +700,8 @@ class RegStruct( ):
         self.registers = registers
         self.value     = None
         self.device    = None
+        self.timestamp = 0
+        self.changed   = True
 
         # compute address range
         self.addr        = min( reg.addr for reg in self.registers )
@@ -529,8 +742,8 @@ class RegStruct( ):
             data[ offset:(offset+reg.word_length) ] = reg.encode()
         return data
 
-    async def read( self ):
-        await self.device.read_regs( (self,) )
+    async def read( self, max_age=None ):
+        await self.device.read_regs( (self,), max_age=max_age )
 
     async def write( self ):
         return await self.device.write_regs( (self,) )
@@ -563,17 +776,18 @@ class RegDateTimeSplit( RegStruct ):
 #   treat it like a register
 
 class FakeRegister:
+    __slots__ = "key", "value", "_format_value"
+
     def __init__( self, key, value, user_type, decimals ):
         self.key = key
         self.value = value
         if user_type == "float":
-            format_value_fstr = "%%.0%df" % max( decimals, 1 )
-            # adding 0.0 converts -0.0 into 0.0
-            self._format_value = lambda v: format_value_fstr % (0.0 + round( v, decimals ))
-            self.format_value = lambda: format_value_fstr % (0.0 + round( self.value, decimals ))
+            self._format_value = get_float_formatter( decimals )
         else:
-            self._format_value = lambda v: "%d"%v
-            self.format_value = lambda: "%d"%self.value
+            self._format_value = format_int
+
+    def format_value( self ):
+        return self._format_value( self.value )
 
 
 
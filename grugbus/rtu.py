@@ -0,0 +1,316 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+    Native Modbus RTU client.
+
+    pymodbus builds each request through its framer, PDU classes and transaction manager,
+    which on a small ARM board takes about as long as the frame on the wire. This does only
+    what grugbus needs:
+
+        -   CRC16 with a precomputed table
+        -   Read requests are built once and reused, since read plans repeat the same chunks
+        -   Responses are read with their exact expected length, so there is no need to wait
+            for a silent interval to detect the end of a frame, and words are unpacked in one call
+        -   The 3.5 character silence between frames is computed from the serial settings
+
+    Methods have the same positional arguments as the pymodbus client, so it can replace
+    AsyncModbusSerialClient, plus a timeout argument used by adaptive timeouts. It takes the
+    same parameters, unknown ones are ignored:
+
+        modbus = grugbus.rtu.RtuClient( **config.EVSE["SERIAL"] )
+
+    This needs pyserial-asyncio. ThreadedRtuClient does the serial I/O in a thread instead,
+    and only needs pyserial.
+"""
+
+import asyncio, struct, time, logging, types, threading, queue
+from asyncio.exceptions import TimeoutError
+from pymodbus.exceptions import ModbusException, ConnectionException
+from pymodbus.pdu import ExceptionResponse
+import config
+from .plan import PlanCache
+from .tcp import Response, _pack_bits, _unpack_bits
+
+log = logging.getLogger(__name__)
+
+def _make_crc_table():
+    table = []
+    for n in range( 256 ):
+        crc = n
+        for i in range( 8 ):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append( crc )
+    return tuple( table )
+
+_CRC_TABLE = _make_crc_table()
+
+def crc16( data ):
+    """
+        Modbus CRC. Computed over a frame including its CRC, the result is 0 if the CRC is valid.
+    """
+    crc   = 0xFFFF
+    table = _CRC_TABLE
+    for b in data:
+        crc = (crc >> 8) ^ table[ (crc ^ b) & 0xFF ]
+    return crc
+
+def _frame( slave, pdu ):
+    frame = bytearray( 1 + len(pdu) + 2 )
+    frame[0] = slave
+    frame[1:-2] = pdu
+    struct.pack_into( "<H", frame, len(frame)-2, crc16( memoryview( frame )[:-2] ))
+    return bytes( frame )
+
+class RtuClient:
+    accepts_timeout = True     # methods take a timeout argument, see SlaveDevice._timeout_arg()
+
+    def __init__( self, port, baudrate=9600, bytesize=8, parity="N", stopbits=1, timeout=0.3, **kwargs ):
+        """
+            :param  timeout:    seconds to wait for a response
+            Other parameters are the serial settings, like pymodbus.
+        """
+        self.comm_params = types.SimpleNamespace( host=port, port=port, baudrate=baudrate, bytesize=bytesize,
+                                                  parity=parity, stopbits=stopbits, timeout_connect=timeout )
+        self.timeout     = timeout
+        char_time        = (1 + bytesize + (parity != "N") + stopbits) / baudrate
+        # spec says 1.75ms above 19200 bauds
+        self.frame_gap   = 3.5*char_time if baudrate <= 19200 else 0.00175
+        self._lock       = asyncio.Lock()       # used by SlaveDevice.connect()
+        self._io_lock    = asyncio.Lock()
+        self._requests   = PlanCache( config.GRUGBUS_RTU_FRAME_CACHE_SIZE )   # (slave, fcode, addr, count): read request frame
+        self._reader     = None
+        self._writer     = None
+        self._last_io    = 0
+        self._quiet_until = 0                   # after a timeout, a late response may arrive until then
+
+    @property
+    def connected( self ):
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def connect( self ):
+        import serial_asyncio
+        p = self.comm_params
+        try:
+            self._reader, self._writer = await serial_asyncio.open_serial_connection( url=p.port, baudrate=p.baudrate,
+                bytesize=p.bytesize, parity=p.parity, stopbits=p.stopbits )
+        except OSError as e:
+            raise ConnectionException( "%s: %s" % (p.port, e) )
+        return True
+
+    def close( self ):
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+
+    async def _flush( self, until=0 ):
+        # discard the rest of a bad frame, or a late response, until the line is silent after until
+        try:
+            while await asyncio.wait_for( self._reader.read( 256 ), max( until-time.monotonic(), 2*self.frame_gap )):
+                pass    # empty read means EOF, the port was closed
+        except TimeoutError:
+            pass
+
+    async def _execute( self, slave, frame, response_length, timeout=None ):
+        """
+            Sends a request frame and returns the response PDU, without slave address and CRC.
+            response_length is the expected length of a valid response.
+            timeout is shorter than self.timeout with adaptive timeouts. When it expires, or the caller
+            is cancelled, the device may still answer: the next request discards it, waiting until
+            self.timeout after this request if needed, otherwise it would get this response.
+        """
+        timeout = timeout or self.timeout
+        async with self._io_lock:
+            if not self.connected:
+                raise ConnectionException( "%s: not connected" % self.comm_params.port )
+            if self._quiet_until:
+                await self._flush( self._quiet_until )
+                self._quiet_until = 0
+            wait = self._last_io + self.frame_gap - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep( wait )
+            sent = time.monotonic()
+            try:
+                self._writer.write( frame )
+                reader = self._reader
+                head = await asyncio.wait_for( reader.readexactly( 2 ), timeout )
+                if head[1] & 0x80:
+                    response_length = 5
+                resp = head + await asyncio.wait_for( reader.readexactly( response_length-2 ), timeout )
+                if crc16( resp ):
+                    await self._flush()
+                    raise ModbusException( "%s: bad CRC" % self.comm_params.port )
+                if resp[0] != slave:
+                    await self._flush()
+                    raise ModbusException( "%s: response from slave %d, expected %d" % (self.comm_params.port, resp[0], slave) )
+                return memoryview( resp )[1:-2]
+            except (TimeoutError, asyncio.CancelledError):
+                self._quiet_until = sent + max( timeout, self.timeout )
+                raise
+            except asyncio.IncompleteReadError as e:
+                self.close()
+                raise ConnectionException( "%s: %s" % (self.comm_params.port, e) )
+            finally:
+                self._last_io = time.monotonic()
+
+    async def _read( self, fcode, address, count, slave, timeout ):
+        key = (slave, fcode, address, count)
+        frame = self._requests.get( key )
+        if frame is None:
+            frame = self._requests.put( key, _frame( slave, struct.pack( ">BHH", fcode, address, count )))
+        if fcode > 2:
+            pdu = await self._execute( slave, frame, 5 + 2*count, timeout )
+            if pdu[0] & 0x80:
+                return ExceptionResponse( fcode, pdu[1] )
+            return Response( fcode, registers=list( struct.unpack_from( ">%dH" % count, pdu, 2 )))
+        else:
+            pdu = await self._execute( slave, frame, 5 + (count+7)//8, timeout )
+            if pdu[0] & 0x80:
+                return ExceptionResponse( fcode, pdu[1] )
+            return Response( fcode, bits=_unpack_bits( pdu[2:] ))
+
+    async def _write( self, slave, pdu, timeout ):
+        resp = await self._execute( slave, _frame( slave, pdu ), 8, timeout )
+        if resp[0] & 0x80:
+            return ExceptionResponse( pdu[0], resp[1] )
+        return Response( pdu[0] )
+
+    async def read_coils( self, address, count=1, slave=0, timeout=None ):
+        return await self._read( 1, address, count, slave, timeout )
+
+    async def read_discrete_inputs( self, address, count=1, slave=0, timeout=None ):
+        return await self._read( 2, address, count, slave, timeout )
+
+    async def read_holding_registers( self, address, count=1, slave=0, timeout=None ):
+        return await self._read( 3, address, count, slave, timeout )
+
+    async def read_input_registers( self, address, count=1, slave=0, timeout=None ):
+        return await self._read( 4, address, count, slave, timeout )
+
+    async def write_coil( self, address, value, slave=0, timeout=None ):
+        return await self._write( slave, struct.pack( ">BHH", 5, address, 0xFF00 if value else 0 ), timeout )
+
+    async def write_register( self, address, value, slave=0, timeout=None ):
+        return await self._write( slave, struct.pack( ">BHH", 6, address, value ), timeout )
+
+    async def write_coils( self, address, values, slave=0, timeout=None ):
+        data = _pack_bits( values )
+        return await self._write( slave, struct.pack( ">BHHB", 15, address, len(values), len(data) ) + data, timeout )
+
+    async def write_registers( self, address, values, slave=0, timeout=None ):
+        return await self._write( slave, struct.pack( ">BHHB%dH" % len(values), 16, address, len(values), 2*len(values), *values ), timeout )
+
+    async def readwrite_registers( self, read_address=0, read_count=0, write_address=0, address=None, values=(), slave=0, timeout=None ):
+        pdu = struct.pack( ">BHHHHB%dH" % len(values), 23, read_address, read_count, write_address, len(values), 2*len(values), *values )
+        resp = await self._execute( slave, _frame( slave, pdu ), 5 + 2*read_count, timeout )
+        if resp[0] & 0x80:
+            return ExceptionResponse( 23, resp[1] )
+        return Response( 23, registers=list( struct.unpack_from( ">%dH" % read_count, resp, 2 )))
+
+class ThreadedRtuClient( RtuClient ):
+    """
+        Same as RtuClient, but each port has a thread doing the request/response exchange with
+        blocking I/O, so timing on the wire does not depend on the event loop: a slow callback
+        or MQTT burst no longer delays the frame gap, or the reading of a response that arrived.
+
+        Requests are passed to the thread in a queue.SimpleQueue and results come back with
+        loop.call_soon_threadsafe(). The thread only handles bytes, frames are built and decoded
+        by RtuClient on the event loop.
+    """
+    def __init__( self, *args, **kwargs ):
+        super().__init__( *args, **kwargs )
+        self._serial  = None
+        self._queue   = queue.SimpleQueue()     # (loop, future, serial, frame, response_length, timeout)
+        self._thread  = None
+
+    @property
+    def connected( self ):
+        return self._serial is not None and self._serial.is_open
+
+    async def connect( self ):
+        import serial
+        p = self.comm_params
+        try:
+            self._serial = serial.Serial( p.port, baudrate=p.baudrate, bytesize=p.bytesize, parity=p.parity, stopbits=p.stopbits, timeout=self.timeout )
+        except OSError as e:
+            raise ConnectionException( "%s: %s" % (p.port, e) )
+        if not self._thread:
+            self._thread = threading.Thread( target=self._run, name="rtu %s" % p.port, daemon=True )
+            self._thread.start()
+        return True
+
+    def close( self ):
+        if self._serial:
+            self._serial.close()
+            self._serial = None
+
+    async def _execute( self, slave, frame, response_length, timeout=None ):
+        # if this is cancelled, the thread still completes the transaction, so it is not out of sync
+        if not self.connected:
+            raise ConnectionException( "%s: not connected" % self.comm_params.port )
+        loop = asyncio.get_running_loop()
+        fut  = loop.create_future()
+        self._queue.put( (loop, fut, self._serial, slave, frame, response_length, timeout or self.timeout) )
+        return await fut
+
+    @staticmethod
+    def _set_result( fut, result, exc ):
+        if not fut.cancelled():
+            if exc:
+                fut.set_exception( exc )
+            else:
+                fut.set_result( result )
+
+    def _run( self ):
+        while True:
+            loop, fut, ser, slave, frame, response_length, timeout = self._queue.get()
+            result = exc = None
+            try:
+                result = self._transaction( ser, slave, frame, response_length, timeout )
+            except Exception as e:
+                exc = e
+            loop.call_soon_threadsafe( self._set_result, fut, result, exc )
+
+    def _transaction( self, ser, slave, frame, response_length, timeout ):
+        port = self.comm_params.port
+        if self._quiet_until:
+            self._flush_serial( ser, self._quiet_until )
+            self._quiet_until = 0
+        wait = self._last_io + self.frame_gap - time.monotonic()
+        if wait > 0:
+            time.sleep( wait )
+        sent = time.monotonic()
+        try:
+            try:
+                ser.timeout = timeout
+                ser.write( frame )
+                resp = ser.read( 2 )
+                if len( resp ) == 2:
+                    if resp[1] & 0x80:
+                        response_length = 5
+                    resp += ser.read( response_length-2 )
+            except (OSError, ValueError) as e:     # ValueError if the port was closed
+                raise ConnectionException( "%s: %s" % (port, e) )
+            if len( resp ) < response_length:
+                # the response may still come, see RtuClient._execute()
+                self._quiet_until = sent + max( timeout, self.timeout )
+                raise TimeoutError( "%s: timeout" % port )
+            if crc16( resp ):
+                self._flush_serial( ser )
+                raise ModbusException( "%s: bad CRC" % port )
+            if resp[0] != slave:
+                self._flush_serial( ser )
+                raise ModbusException( "%s: response from slave %d, expected %d" % (port, resp[0], slave) )
+            return memoryview( resp )[1:-2]
+        finally:
+            self._last_io = time.monotonic()
+
+    def _flush_serial( self, ser, until=0 ):
+        # discard the rest of a bad frame, or a late response, until the line is silent after until
+        try:
+            while True:
+                ser.timeout = max( until-time.monotonic(), 2*self.frame_gap )
+                if not ser.read( 256 ):
+                    break
+        except (OSError, ValueError):
+            pass
@@ -0,0 +1,192 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import time, logging
+import config
+from .plan import PlanCache
+from .bus import PRIORITY_FAST, PRIORITY_BULK
+
+log = logging.getLogger(__name__)
+
+class PollScheduler:
+    """
+        Deadline-driven register polling.
+
+        Each register (or group) is added with a period: it must be read again when it is older
+        than that. Period None means the register is read on every tick. The caller keeps its
+        Metronome and calls read() on every tick, which reads all registers that are due.
+
+        Reads that include registers read on every tick get PRIORITY_FAST on the bus, others PRIORITY_BULK.
+
+        Registers that will be due soon are merged into the transaction if it is cheaper, according
+        to the device cost model, than reading them when they are due: for example if they sit in a
+        hole that is read anyway, or if they would need a transaction of their own later.
+
+            scheduler = PollScheduler( device )
+            scheduler.add( [device.total_power, device.phase_1_power] )    # every tick
+            scheduler.add( device.total_import_kwh, 60 )                   # once per minute
+            while True:
+                await tick.wait()
+                regs = await scheduler.read()
+                if scheduler.cycle_done:
+                    # all registers were read at least once since last cycle
+    """
+    def __init__( self, device, cycle_period=None, merge_window=0.5, jitter=0.1 ):
+        """
+            :param  cycle_period:   registers with a longer period are not waited for to set cycle_done,
+                                    so slow energy counters don't delay processes waiting for a full cycle.
+                                    None means all registers.
+            :param  merge_window:   registers due within this fraction of their period can be read early
+            :param  jitter:         registers due within this fraction of their period are due now, so
+                                    the jitter of tick wakeups does not make them miss a tick
+        """
+        self.device       = device
+        self.cycle_period = cycle_period
+        self.merge_window = merge_window
+        self.jitter       = jitter
+        self.entries      = {}    # reg: [period, deadline]
+        self.unread       = set() # registers not read yet in this cycle
+        self.cycle_done   = False
+        self.merge_cost   = PlanCache( config.GRUGBUS_PLAN_CACHE_SIZE )   # cost of merging a register into a read
+        self.due_cost     = {}    # reg: cost of reading it when it is due
+        self.plans        = PlanCache( config.GRUGBUS_PLAN_CACHE_SIZE )   # set of due registers: ReadPlan
+        self.plans_generation = device.plan_cache.generation
+
+    def add( self, regs, period=None ):
+        """
+            Adds registers to poll, or changes their period.
+            regs can be a single register or a list.
+        """
+        if not isinstance( regs, (list, tuple, set) ):
+            regs = (regs,)
+        for reg in regs:
+            if reg in self.entries:
+                self.entries[reg][0] = period
+            else:
+                self.entries[reg] = [period, 0]    # read on next tick
+        self.unread = self._cycle_regs()
+        self.merge_cost.clear()
+        self.due_cost.clear()
+
+    def remove( self, regs ):
+        if not isinstance( regs, (list, tuple, set) ):
+            regs = (regs,)
+        for reg in regs:
+            self.entries.pop( reg, None )
+            self.unread.discard( reg )
+        self.merge_cost.clear()
+        self.due_cost.clear()
+
+    def _cycle_regs( self ):
+        cp = self.cycle_period
+        return { reg for reg, (period, deadline) in self.entries.items() if cp is None or period is None or period <= cp }
+
+    def due( self, now ):
+        """
+            Returns the list of registers to read now: registers whose deadline is due,
+            plus registers due soon if reading them now is cheap.
+        """
+        due  = []
+        soon = []
+        for reg, (period, deadline) in self.entries.items():
+            if period is None:
+                due.append( reg )
+            else:
+                t = deadline - now
+                if t <= period*self.jitter:
+                    due.append( reg )
+                elif t <= period*self.merge_window:
+                    soon.append( (deadline, reg) )
+
+        if not (due and soon):
+            return due
+
+        # Reading a register early by a fraction f of its period means reading it 1/(1-f) times more often,
+        # so merge it if that costs less than reading it when it is due.
+        frozen_due = frozenset( due )
+        regs = due
+        for deadline, reg in soon:
+            period = self.entries[reg][0]
+            if self._merge_cost( frozen_due, reg ) < self._due_cost( reg ) * (1 - (deadline-now)/period):
+                regs.append( reg )
+        return regs
+
+    def _merge_cost( self, due, reg ):
+        """
+            Returns the cost of adding reg to a read of registers due
+        """
+        key = (due, reg)
+        c = self.merge_cost.get( key )
+        if c is None:
+            c = self.merge_cost.put( key, self._cost( due | {reg} ) - self._cost( due ))
+        return c
+
+    def _due_cost( self, reg ):
+        """
+            Returns the cost of reading reg when it is due, with registers read on every tick
+        """
+        c = self.due_cost.get( reg )
+        if c is None:
+            always = { r for r, (period, deadline) in self.entries.items() if period is None }
+            c = self.due_cost[ reg ] = self._cost( always | {reg} ) - self._cost( always )
+        return c
+
+    def _cost( self, regs ):
+        if not regs:
+            return 0
+        cost = self.device.cost_model.cost
+        return sum( cost( fcode, chunk[-1][1]-chunk[0][0] ) for fcode, chunk in self.device._plan_chunks( regs, None ))
+
+    def _plan( self, regs ):
+        # Ticks mostly read the same sets of registers, so keep their plans. They are dropped with
+        # the device's plans, when it learns unreadable addresses or a smaller max_regs_in_command.
+        device = self.device
+        if self.plans_generation != device.plan_cache.generation:
+            self.plans_generation = device.plan_cache.generation
+            self.plans.clear()
+            self.merge_cost.clear()
+            self.due_cost.clear()
+        key = frozenset( regs )
+        return self.plans.get( key ) or self.plans.put( key, device.make_read_plan( regs ))
+
+    async def read( self ):
+        """
+            Reads registers that are due, and returns the list of registers read, like read_regs(),
+            but only those added to this scheduler.
+            If it fails, deadlines are not updated, so registers will be read again on the next tick.
+            Sets cycle_done to True if all registers were read at least once since the last time.
+        """
+        self.cycle_done = False
+        now  = time.monotonic()
+        regs = self.due( now )
+        if not regs:
+            return []
+        entries  = self.entries
+        priority = PRIORITY_FAST if any( entries[reg][0] is None for reg in regs ) else PRIORITY_BULK
+        # read_regs() can return more registers than asked, if the read was merged with another
+        # or if the device decodes accidental registers: they are fresh, so update their deadlines too,
+        # but only return registers this scheduler polls.
+        return self._done( await self.device.read_regs( self._plan( regs ), priority=priority ), now )
+
+    def loaded( self, regs ):
+        """
+            Does the bookkeeping of read() for registers read elsewhere, for example by a poller
+            process (see grugbus.shm), and returns those added to this scheduler.
+        """
+        self.cycle_done = False
+        return self._done( regs, time.monotonic() )
+
+    def _done( self, regs, now ):
+        entries = self.entries
+        regs = [ reg for reg in regs if reg in entries ]
+        for reg in regs:
+            e = entries[ reg ]
+            if e[0] is not None:
+                e[1] = now + e[0]
+
+        unread = self.unread
+        unread.difference_update( regs )
+        if not unread:
+            self.cycle_done = True
+            self.unread = self._cycle_regs()
+        return regs
@@ -0,0 +1,325 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+    Shared memory register store, to run bus pollers in separate processes.
+
+    Each poller process owns the modbus clients of its buses, and publishes decoded register
+    values into a shared memory region after each read. The controller process creates the
+    same devices without modbus client, and loads the values into their registers, so code
+    using reg.value, reg.timestamp, device.is_online, observers and snapshots does not change.
+
+    PollerProcess does all of this, see pv_controller with config.SHM_POLLERS:
+
+        meter  = SDM630( None, ... )     # no modbus client in the controller
+        poller = grugbus.shm.PollerProcess( "pv_meter", [meter], make_poller, ... )
+        tg.create_task( poller.run() )
+        while True:
+            regs = await poller.wait( meter )
+
+    make_poller() is called in the child process, and returns the same devices with a modbus
+    client, and the coroutine polling them. Only buses that the controller does not write to
+    can be moved to a poller process, since writes are not forwarded.
+
+    RegisterStore can also be used alone. Poller process:
+
+        store = grugbus.shm.RegisterStore( "pv", [meter, solis1, solis2], create=True )
+        store.attach( meter )       # publish after each read of this device, and when it fails
+        ...poll as usual...
+
+    Controller process, with devices made from the same register maps:
+
+        store = grugbus.shm.RegisterStore( "pv", [meter, solis1, solis2] )
+        while True:
+            regs = store.load( meter )     # None if nothing was published since the last load
+
+    The layout is generated from the register lists, in order: for each device, a sequence
+    counter, then doubles: checksum of the block, time of the last read, is_online, and for
+    each register its timestamp and values. None is stored as NaN. Both processes must make the devices
+    from the same register maps, this is checked with a signature of the layout.
+
+    Each device block is a seqlock: the writer makes the counter odd while it writes, and
+    even when it is done, readers copy the block and retry if the counter was odd or changed.
+    So readers never block the poller, and never see half of a read. Python has no memory
+    barriers, so on weakly ordered CPUs like ARM the counter alone could let a reader see it
+    even with stale values: the writer also stores a crc32 of the block, which the reader
+    checks on its copy. If the block is still being written after a few tries, load() returns
+    None, and the caller gets the values on its next load().
+
+    Timestamps are time.monotonic(), which is the same clock in all processes on Linux.
+"""
+
+import os, math, zlib, time, asyncio, logging, multiprocessing
+from multiprocessing import shared_memory, resource_tracker
+from .registers import RegBase
+
+log = logging.getLogger(__name__)
+
+NAN = float( "nan" )
+
+class RegisterStore:
+    def __init__( self, name, devices, create=False ):
+        """
+            :param  name:       name of the shared memory region
+            :param  devices:    all devices in the store, in the same order in all processes
+            :param  create:     True in the poller process, which creates the region
+        """
+        self.layout = {}    # device.key: (index, base, size, { reg: offset })
+        desc = []
+        pos  = 0
+        for i, device in enumerate( devices ):
+            base = pos
+            pos += 3        # checksum, last read time, is_online
+            offsets = {}
+            for reg in device.registers:
+                if isinstance( reg, RegBase ):
+                    offsets[ reg ] = pos
+                    desc.append( "%s.%s.%d" % (device.key, reg.key, reg.nvalues) )
+                    pos += 1 + reg.nvalues
+            self.layout[ device.key ] = (i+1, base, pos-base, offsets)
+        signature = zlib.crc32( ";".join( desc ).encode() )
+        nseq = len( self.layout ) + 1  # signature, then sequence counters
+        size = 8*(nseq + pos)
+
+        if create:
+            try:
+                self.shm = shared_memory.SharedMemory( name, create=True, size=size )
+            except FileExistsError:     # left over by a poller that crashed
+                old = shared_memory.SharedMemory( name )
+                old.unlink()
+                old.close()
+                self.shm = shared_memory.SharedMemory( name, create=True, size=size )
+        else:
+            self.shm = shared_memory.SharedMemory( name )
+            # Before python 3.13, the resource tracker unlinks regions attached by this process
+            # when it exits, which would remove the poller's region
+            resource_tracker.unregister( self.shm._name, "shared_memory" )
+
+        self.create = create
+        self.seq    = self.shm.buf[ :8*nseq ].cast( "Q" )
+        self.raw    = self.shm.buf[ 8*nseq:size ]
+        self.values = self.raw.cast( "d" )
+        if create:
+            self.seq[0] = signature
+        elif self.seq[0] != signature:
+            self.close()
+            raise ValueError( "RegisterStore %s: layout does not match the poller's register maps" % name )
+        self.last_seq = [0] * nseq   # counter value at the last load(), per device
+        self.notify_fd = None        # poller side: a byte is written to this pipe after each publication
+
+    def close( self ):
+        self.seq.release()
+        self.values.release()
+        self.raw.release()
+        self.shm.close()
+        if self.create:
+            self.shm.unlink()
+
+    #
+    #   Poller side
+    #
+
+    def attach( self, device ):
+        """
+            Publishes registers after each read of this device, and its state when a transaction fails,
+            so the controller knows it is offline.
+        """
+        device.observe( self.layout[ device.key ][3], lambda regs: self.publish( device, regs ), deadband=None )
+        device.failure_callbacks.append( self.publish )
+
+    def publish( self, device, regs=() ):
+        """
+            Writes the values of regs, and the device state. Without regs, only the device state is
+            written, for example to publish that it is offline.
+        """
+        i, base, size, offsets = self.layout[ device.key ]
+        seq  = self.seq
+        vals = self.values
+        seq[i] += 1     # odd: write in progress
+        vals[ base+1 ] = device.version_timestamp
+        vals[ base+2 ] = device.is_online
+        for reg in regs:
+            o = offsets.get( reg )
+            if o is None:
+                continue
+            vals[ o ] = reg.timestamp
+            v = reg.value
+            if reg.nvalues == 1:
+                vals[ o+1 ] = NAN if v is None else v
+            else:
+                for n in range( reg.nvalues ):
+                    vals[ o+1+n ] = NAN if v is None or v[n] is None else v[n]
+        vals[ base ] = zlib.crc32( self.raw[ 8*(base+1):8*(base+size) ] )
+        seq[i] += 1
+        self.notify()
+
+    def notify( self ):
+        if self.notify_fd is not None:
+            try:
+                os.write( self.notify_fd, b"\0" )
+            except BlockingIOError:
+                pass    # the pipe is full, the reader is behind but will load everything anyway
+
+    #
+    #   Controller side
+    #
+
+    def load( self, device, max_tries=10 ):
+        """
+            Copies values published since the last load into the device's registers, and notifies its
+            observers. Returns the list of registers updated, which is empty if only the device state
+            was published. Returns None if there was no new publication, or if the block was being
+            written during all tries.
+        """
+        i, base, size, offsets = self.layout[ device.key ]
+        seq = self.seq
+        for n in range( max_tries ):
+            if n:
+                time.sleep( 0 )     # let the poller finish its write
+            s = seq[i]
+            if s & 1:
+                continue    # write in progress
+            if s == self.last_seq[i]:
+                return None
+            raw = bytes( self.raw[ 8*base:8*(base+size) ] )
+            if seq[i] == s:
+                data = memoryview( raw ).cast( "d" ).tolist()
+                if data[0] == zlib.crc32( raw[8:] ):
+                    break
+        else:
+            log.debug( "RegisterStore: %s: block is being written, not loaded", device.key )
+            return None
+        self.last_seq[i] = s
+
+        device.is_online = bool( data[2] )
+        updated = []
+        for reg, o in offsets.items():
+            o -= base
+            t = data[ o ]
+            if t == reg.timestamp:
+                continue
+            reg.timestamp = t
+            if reg.nvalues == 1:
+                reg.value = self._convert( reg, data[ o+1 ] )
+            else:
+                reg.value = [ self._convert( reg, x ) for x in data[ o+1:o+1+reg.nvalues ] ]
+            reg.changed = True
+            updated.append( reg )
+
+        if updated:
+            device.version += 1
+            device.version_timestamp = data[1]
+            device._update_snapshot( updated )
+            if device.observers:
+                device._notify_observers( updated )
+        return updated
+
+    @staticmethod
+    def _convert( reg, x ):
+        if math.isnan( x ):
+            return None
+        if reg.user_type == "float":
+            return x
+        if reg.user_type == "bool":
+            return bool( x )
+        return int( x )
+
+def _poller_main( name, factory, args, conn ):
+    # child process entry point, see PollerProcess
+    asyncio.run( _poller( name, factory, args, conn ))
+
+async def _poller( name, factory, args, conn ):
+    devices, coroutine = factory( *args )
+    store = RegisterStore( name, devices, create=True )
+    try:
+        os.set_blocking( conn.fileno(), False )
+        store.notify_fd = conn.fileno()
+        for device in devices:
+            store.attach( device )
+        store.notify()      # the region is ready
+        await coroutine
+    finally:
+        store.close()
+
+class PollerProcess:
+    """
+        Polls devices in a child process, and loads what it publishes into the same devices made
+        without modbus client in this process, see the module docstring.
+
+        The child writes a byte to a pipe after each publication, so loads happen right after reads,
+        without polling the shared memory. If the child dies, its devices are set offline, and it is
+        started again after a second.
+    """
+    def __init__( self, name, devices, factory, *args ):
+        """
+            :param  name:       name of the shared memory region
+            :param  devices:    devices made without modbus client, loaded from the region
+            :param  factory:    called in the child with args, returns ( devices, coroutine ): the same
+                                devices with a modbus client, in the same order, and the coroutine polling
+                                them. It must be a module level function, the child is spawned, not forked.
+        """
+        self.name    = name
+        self.devices = devices
+        self.factory = factory
+        self.args    = args
+        self.context = multiprocessing.get_context( "spawn" )   # fork is not safe with a running event loop
+        self.events  = { device.key: asyncio.Event() for device in devices }
+        self.updated = { device.key: {} for device in devices }  # registers loaded since the last wait()
+
+    async def wait( self, device ):
+        """
+            Waits for the next publication for this device, and returns the registers loaded since the
+            last call. The list is empty if the device is offline.
+        """
+        event = self.events[ device.key ]
+        await event.wait()
+        event.clear()
+        regs = list( self.updated[ device.key ] )
+        self.updated[ device.key ].clear()
+        return regs
+
+    def _loaded( self, device, regs ):
+        self.updated[ device.key ].update( dict.fromkeys( regs ))
+        self.events[ device.key ].set()
+
+    async def run( self ):
+        """
+            Runs the child process and loads its publications, until cancelled
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            reader, writer = self.context.Pipe( duplex=False )
+            process = self.context.Process( target=_poller_main, args=( self.name, self.factory, self.args, writer ),
+                                            name="poller %s" % self.name, daemon=True )
+            process.start()
+            writer.close()
+            fd = reader.fileno()
+            readable = asyncio.Event()
+            loop.add_reader( fd, readable.set )
+            store = None
+            try:
+                while True:
+                    await readable.wait()
+                    readable.clear()
+                    if not os.read( fd, 4096 ):
+                        break   # EOF, the child exited
+                    if store is None:
+                        store = RegisterStore( self.name, self.devices )
+                    for device in self.devices:
+                        regs = store.load( device )
+                        if regs is not None:
+                            self._loaded( device, regs )
+            except BaseException:
+                process.terminate()
+                raise
+            finally:
+                loop.remove_reader( fd )
+                reader.close()
+                if store:
+                    store.close()
+                process.join( 1 )
+            log.error( "PollerProcess %s: exited with code %s, restarting", self.name, process.exitcode )
+            for device in self.devices:
+                device.is_online = False
+                self._loaded( device, () )
+            await asyncio.sleep( 1 )
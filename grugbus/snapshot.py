@@ -0,0 +1,41 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+class Snapshot:
+    """
+        Immutable copy of all register values of a device, see DeviceBase.snapshot().
+
+        Values are in a tuple, indexed by a dict shared by all snapshots of the device, so making a
+        snapshot is one tuple() and reading it does not copy anything. A consumer that awaits between
+        reading several values can keep a snapshot instead, and all values will be from the same read.
+        Snapshots of several devices taken without await in between are consistent with each other.
+
+            snap = meter.snapshot()
+            snap.total_power, snap[ meter.frequency ], snap["frequency"]
+
+        version increases with each read that decoded registers, timestamp is the monotonic time of
+        that read.
+    """
+    __slots__ = "version", "timestamp", "values", "_index"
+
+    def __init__( self, version, timestamp, values, index ):
+        self.version   = version
+        self.timestamp = timestamp
+        self.values    = values
+        self._index    = index  # reg or reg.key: position in values
+
+    def __getitem__( self, reg ):
+        return self.values[ self._index[ reg ] ]
+
+    def __getattr__( self, key ):
+        try:
+            return self.values[ self._index[ key ] ]
+        except KeyError:
+            raise AttributeError( key )
+
+    def get( self, reg, default=None ):
+        i = self._index.get( reg )
+        return default if i is None else self.values[ i ]
+
+    def __repr__( self ):
+        return "<Snapshot v%d>" % self.version
@@ -0,0 +1,173 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import time, math, collections
+import config
+
+class LatencyHistogram:
+    """
+        Histogram of transaction durations with logarithmic buckets, 10 per decade from 1ms to 10s,
+        so percentiles are within 25% whatever the duration.
+    """
+    __slots__ = "counts", "count", "max"
+    MIN_T      = 0.001
+    PER_DECADE = 10
+    SIZE       = 41
+
+    def __init__( self ):
+        self.counts = [0] * self.SIZE
+        self.count  = 0
+        self.max    = 0.0
+
+    def add( self, t ):
+        if t > self.MIN_T:
+            i = min( math.ceil( math.log10( t/self.MIN_T ) * self.PER_DECADE ), self.SIZE-1 )
+        else:
+            i = 0
+        self.counts[i] += 1
+        self.count     += 1
+        self.max        = max( self.max, t )
+
+    def percentile( self, p ):
+        """
+            Returns the upper bound of the bucket containing percentile p (0-100)
+        """
+        if not self.count:
+            return 0
+        n = p * self.count / 100
+        total = 0
+        for i, c in enumerate( self.counts ):
+            total += c
+            if total >= n:
+                return min( self.MIN_T * 10**(i/self.PER_DECADE), self.max )
+        return self.max
+
+def frame_bytes( fcode, count, write_count=0 ):
+    """
+        Returns the (request, response) sizes in bytes of a Modbus RTU transaction, including CRC.
+        count is the number of registers or bits read, or written for write function codes.
+    """
+    if fcode in (1,2):
+        return 8, 5 + (count+7)//8
+    if fcode in (3,4):
+        return 8, 5 + 2*count
+    if fcode in (5,6):
+        return 8, 8
+    if fcode == 15:
+        return 9 + (count+7)//8, 8
+    if fcode == 16:
+        return 9 + 2*count, 8
+    if fcode == 23:
+        return 13 + 2*write_count, 5 + 2*count
+    return 8, 8
+
+class TransactionStats:
+    """
+        Statistics of a device's modbus transactions since the last reset:
+        latency histograms per function code and chunk size, errors, bytes on the wire, and airtime.
+        Chunk sizes are rounded up to a power of two, to keep the number of histograms small.
+    """
+    def __init__( self ):
+        self.reset()
+
+    def reset( self ):
+        self.start_time   = time.monotonic()
+        self.histograms   = {}      # (fcode, size): LatencyHistogram
+        self.transactions = 0
+        self.retries      = 0
+        self.timeouts     = 0
+        self.errors       = 0
+        self.bytes_tx     = 0
+        self.bytes_rx     = 0
+        self.airtime      = 0.0
+
+    def add( self, fcode, count, duration, write_count=0, airtime=None ):
+        """
+            Records a successful transaction. airtime is the bus time it used, duration by default,
+            pipelined requests overlap so their batch is added to airtime once instead.
+        """
+        size = 1 << (count-1).bit_length() if count > 1 else 1
+        h = self.histograms.get( (fcode, size) )
+        if h is None:
+            h = self.histograms[ (fcode, size) ] = LatencyHistogram()
+        h.add( duration )
+        tx, rx = frame_bytes( fcode, count, write_count )
+        self.transactions += 1
+        self.bytes_tx     += tx
+        self.bytes_rx     += rx
+        self.airtime      += duration if airtime is None else airtime
+
+    def get_stats( self, reset=True ):
+        """
+            Returns a flat dict, latency keys are like "fc3_n16_p95" for function code 3
+            and chunks of 9 to 16 registers. airtime is the fraction of time spent in transactions.
+        """
+        elapsed = time.monotonic() - self.start_time
+        r = {
+            "transactions"  : self.transactions,
+            "retries"       : self.retries,
+            "timeouts"      : self.timeouts,
+            "errors"        : self.errors,
+            "bytes_tx"      : self.bytes_tx,
+            "bytes_rx"      : self.bytes_rx,
+            "airtime"       : self.airtime/elapsed if elapsed else 0,
+        }
+        for (fcode, size), h in sorted( self.histograms.items() ):
+            k = "fc%d_n%d_" % (fcode, size)
+            r[ k+"count" ] = h.count
+            r[ k+"p50" ]   = h.percentile( 50 )
+            r[ k+"p95" ]   = h.percentile( 95 )
+            r[ k+"p99" ]   = h.percentile( 99 )
+            r[ k+"max" ]   = h.max
+        if reset:
+            self.reset()
+        return r
+
+class TimeoutEstimator:
+    """
+        Adaptive transaction timeout for one device.
+
+        A static timeout must be long enough for the slowest device on the port, so when a frame is
+        lost, a fast meter waits as long as a slow inverter. This keeps the device's recent response
+        times, minus the time to transfer the data (from the cost model), so samples from short and
+        long chunks are comparable. The timeout for a transaction is:
+
+            percentile( response times ) * margin + transfer time for this chunk
+
+        clamped between config.GRUGBUS_TIMEOUT_MIN_S and the client's static timeout.
+        Until there are enough samples, and after a timeout, the static timeout is used,
+        so a slow response is not lost twice and gets the chance to raise the estimate.
+    """
+    def __init__( self, cost_model, ceiling, window=100, min_samples=10 ):
+        self.cost_model    = cost_model
+        self.ceiling       = ceiling
+        self.floor         = min( config.GRUGBUS_TIMEOUT_MIN_S, ceiling )
+        self.percentile    = config.GRUGBUS_TIMEOUT_PERCENTILE
+        self.margin        = config.GRUGBUS_TIMEOUT_MARGIN
+        self.samples       = collections.deque( maxlen=window )
+        self.min_samples   = min_samples
+        self.new_samples   = 0
+        self.base          = None   # percentile of samples, updated every few samples
+        self.after_timeout = False
+
+    def _transfer_time( self, fcode, count ):
+        cm = self.cost_model
+        return cm.cost( fcode, count ) - cm.overhead
+
+    def add( self, fcode, count, duration ):
+        self.samples.append( max( 0.0, duration - self._transfer_time( fcode, count )))
+        self.after_timeout = False
+        self.new_samples += 1
+        if self.new_samples >= 10 and len( self.samples ) >= self.min_samples:
+            s = sorted( self.samples )
+            self.base = s[ min( len(s)-1, int( len(s)*self.percentile/100 )) ]
+            self.new_samples = 0
+
+    def timeout_expired( self ):
+        self.after_timeout = True
+
+    def timeout( self, fcode, count ):
+        if self.base is None or self.after_timeout:
+            return self.ceiling
+        t = self.base*self.margin + self._transfer_time( fcode, count )
+        return min( max( t, self.floor ), self.ceiling )
@@ -0,0 +1,167 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+    Pipelined Modbus TCP client.
+
+    pymodbus clients wait for each response before sending the next request. Modbus TCP
+    has transaction IDs in the MBAP header, so several requests can be in flight and the
+    responses matched by ID: a read plan with N chunks then costs about one round trip
+    instead of N. SlaveDevice.read_regs() does this when the client has max_in_flight > 1.
+
+    This implements only the functions grugbus uses, with the same positional arguments
+    as pymodbus, so it can replace AsyncModbusTcpClient:
+
+        modbus = grugbus.tcp.PipelinedTcpClient( "192.168.0.10", 502, max_in_flight=4 )
+
+    Some RS485-to-TCP gateways can't handle several requests at once: use max_in_flight=1,
+    then requests are sent one at a time, like pymodbus does.
+"""
+
+import asyncio, struct, logging, types
+from pymodbus.exceptions import ConnectionException
+from pymodbus.pdu import ExceptionResponse
+
+log = logging.getLogger(__name__)
+
+class Response:
+    """
+        Response with the attributes SlaveDevice uses from pymodbus responses
+    """
+    __slots__ = "function_code", "registers", "bits"
+
+    def __init__( self, function_code, registers=None, bits=None ):
+        self.function_code = function_code
+        self.registers     = registers
+        self.bits          = bits
+
+    def isError( self ):
+        return False
+
+def _unpack_bits( data ):
+    return [ bool( byte & (1<<i) ) for byte in data for i in range( 8 ) ]
+
+def _pack_bits( values ):
+    data = bytearray( (len(values)+7)//8 )
+    for i, v in enumerate( values ):
+        if v:
+            data[i//8] |= 1 << (i%8)
+    return bytes( data )
+
+class PipelinedTcpClient:
+    accepts_timeout = True     # methods take a timeout argument, see SlaveDevice._timeout_arg()
+
+    def __init__( self, host, port=502, timeout=3, max_in_flight=4 ):
+        """
+            :param  timeout:        seconds to wait for each response
+            :param  max_in_flight:  maximum number of requests sent without waiting for a response
+        """
+        self.comm_params   = types.SimpleNamespace( host=host, port=port, timeout_connect=timeout )
+        self.timeout       = timeout
+        self.max_in_flight = max_in_flight
+        self._lock         = asyncio.Lock()     # used by SlaveDevice.connect()
+        self._in_flight    = asyncio.Semaphore( max_in_flight )
+        self._pending      = {}                 # transaction id: future
+        self._tid          = 0
+        self._reader       = None
+        self._writer       = None
+        self._read_task    = None
+
+    @property
+    def connected( self ):
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def connect( self ):
+        p = self.comm_params
+        try:
+            self._reader, self._writer = await asyncio.wait_for( asyncio.open_connection( p.host, p.port ), self.timeout )
+        except OSError as e:
+            raise ConnectionException( "%s:%s %s" % (p.host, p.port, e) )
+        self._read_task = asyncio.create_task( self._read_responses( self._reader ))
+        return True
+
+    def close( self ):
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+        if self._read_task:
+            self._read_task.cancel()
+            self._read_task = None
+        self._fail_pending( ConnectionException( "connection closed" ))
+
+    def _fail_pending( self, exc ):
+        pending, self._pending = self._pending, {}
+        for fut in pending.values():
+            if not fut.done():
+                fut.set_exception( exc )
+
+    async def _read_responses( self, reader ):
+        try:
+            while True:
+                tid, pid, length, unit = struct.unpack( ">HHHB", await reader.readexactly( 7 ))
+                pdu = await reader.readexactly( length-1 )
+                fut = self._pending.pop( tid, None )
+                if fut is None or fut.done():
+                    log.debug( "%s: response to unknown or expired transaction %d", self.comm_params.host, tid )
+                    continue
+                try:
+                    fut.set_result( self._decode( pdu ))
+                except Exception as e:
+                    fut.set_exception( e )
+        except (asyncio.IncompleteReadError, OSError) as e:
+            log.info( "%s: connection lost: %s", self.comm_params.host, e )
+            if self._writer:
+                self._writer.close()
+                self._writer = None
+            self._fail_pending( ConnectionException( "connection lost" ))
+
+    def _decode( self, pdu ):
+        fcode = pdu[0]
+        if fcode & 0x80:
+            return ExceptionResponse( fcode & 0x7F, pdu[1] )
+        if fcode in (1,2):
+            return Response( fcode, bits=_unpack_bits( pdu[2:2+pdu[1]] ))
+        if fcode in (3,4,23):
+            return Response( fcode, registers=list( struct.unpack( ">%dH" % (pdu[1]//2), pdu[2:2+pdu[1]] )))
+        return Response( fcode )
+
+    async def _execute( self, slave, pdu, timeout=None ):
+        async with self._in_flight:
+            if not self.connected:
+                raise ConnectionException( "%s: not connected" % self.comm_params.host )
+            self._tid = tid = (self._tid + 1) & 0xFFFF
+            fut = self._pending[ tid ] = asyncio.get_running_loop().create_future()
+            self._writer.write( struct.pack( ">HHHB", tid, 0, len(pdu)+1, slave ) + pdu )
+            try:
+                return await asyncio.wait_for( fut, timeout or self.timeout )
+            finally:
+                self._pending.pop( tid, None )
+
+    async def read_coils( self, address, count=1, slave=0, timeout=None ):
+        return await self._execute( slave, struct.pack( ">BHH", 1, address, count ), timeout )
+
+    async def read_discrete_inputs( self, address, count=1, slave=0, timeout=None ):
+        return await self._execute( slave, struct.pack( ">BHH", 2, address, count ), timeout )
+
+    async def read_holding_registers( self, address, count=1, slave=0, timeout=None ):
+        return await self._execute( slave, struct.pack( ">BHH", 3, address, count ), timeout )
+
+    async def read_input_registers( self, address, count=1, slave=0, timeout=None ):
+        return await self._execute( slave, struct.pack( ">BHH", 4, address, count ), timeout )
+
+    async def write_coil( self, address, value, slave=0, timeout=None ):
+        return await self._execute( slave, struct.pack( ">BHH", 5, address, 0xFF00 if value else 0 ), timeout )
+
+    async def write_register( self, address, value, slave=0, timeout=None ):
+        return await self._execute( slave, struct.pack( ">BHH", 6, address, value ), timeout )
+
+    async def write_coils( self, address, values, slave=0, timeout=None ):
+        data = _pack_bits( values )
+        return await self._execute( slave, struct.pack( ">BHHB", 15, address, len(values), len(data) ) + data, timeout )
+
+    async def write_registers( self, address, values, slave=0, timeout=None ):
+        return await self._execute( slave, struct.pack( ">BHHB%dH" % len(values), 16, address, len(values), 2*len(values), *values ), timeout )
+
+    async def readwrite_registers( self, read_address=0, read_count=0, write_address=0, address=None, values=(), slave=0, timeout=None ):
+        return await self._execute( slave, struct.pack( ">BHHHHB%dH" % len(values), 23, read_address, read_count,
+                                                        write_address, len(values), 2*len(values), *values ), timeout )
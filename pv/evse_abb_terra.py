@@ -32,7 +32,9 @@ class EVSE( grugbus.SlaveDevice ):
         # Modbus polling
         self.tick      = Metronome( config.POLL_PERIOD_EVSE )   # how often we poll it over modbus
         self.rwr_current_limit.value = 0.0
-        self.regs_to_read = (
+        # everything is needed by the router, so read it all on every tick
+        self.scheduler = grugbus.PollScheduler( self )
+        self.scheduler.add( [
             self.charge_state       ,
             self.current_limit      ,
             # self.current            ,
@@ -40,7 +42,7 @@ class EVSE( grugbus.SlaveDevice ):
             self.energy             ,
             self.error_code         ,
             self.socket_state
-        )
+        ] )
 
         # Fires when all registers are read, if some other process wants to read them
         self.event_all = asyncio.Event() 
@@ -52,7 +54,7 @@ class EVSE( grugbus.SlaveDevice ):
         while True:
             try:
                 await self.tick.wait()
-                for reg in await self.read_regs( self.regs_to_read ):
+                for reg in await self.scheduler.read():
                     mqtt.publish_reg( topic, reg )
 
                 if config.MAINBOARD_FLASH_LEDS:
@@ -25,7 +25,7 @@ log = logging.getLogger(__name__)
 ########################################################################################
 class SDM630( grugbus.SlaveDevice ):
     def __init__( self, modbus, modbus_addr, key, name, mqtt, mqtt_topic ):
-        super().__init__( modbus, modbus_addr, key, name, Eastron_SDM630.MakeRegisters() ),
+        super().__init__( modbus, modbus_addr, key, name, Eastron_SDM630.MakeRegisters(), decode_accidental=True, skip_unchanged=True ),
         self.mqtt        = mqtt
         self.mqtt_topic  = mqtt_topic
 
@@ -33,27 +33,25 @@ class SDM630( grugbus.SlaveDevice ):
         self.event_power = asyncio.Event()  # Fires every time frequent_regs below are read
         self.event_all   = asyncio.Event()  # Fires when all registers are read, for slower processes
         self.tick = Metronome(config.POLL_PERIOD_METER)  # fires a tick on every period to read periodically, see misc.py
+        self.keepalive = {}     # reg: time to publish it even if it did not change
+        self.poller    = None   # grugbus.shm.PollerProcess that reads this meter, see make_poller()
 
         # For power routing to work we need to read total_power frequently. So we don't read 
-        # ALL registers every time. Instead, gather the unimportant ones in little groups
-        # and frequently read THE important register (total_power) + one group.
-        # Unimportant registers will be updated less often, who cares.
-        frequent_regs = [ 
+        # ALL registers every time. Power is read on every tick, unimportant registers
+        # are read less often, and the scheduler merges them into power reads when it's cheap.
+        self.scheduler = grugbus.PollScheduler( self, cycle_period=config.POLL_PERIOD_SLOW )
+        self.scheduler.add( [ 
             self.total_power    ,
             self.phase_1_power  ,
             self.phase_2_power  ,
             self.phase_3_power  ,
-        ]
-        all_regs = [
+        ] )
+        self.scheduler.add( [
             self.total_volt_amps                  ,    # required for fakemeter
             self.total_var                        ,    # required for fakemeter
             self.total_power_factor               ,    # required for fakemeter
             self.total_phase_angle                ,    # required for fakemeter
             self.frequency                        ,    # required for fakemeter
-            self.total_import_kwh                 ,    # required for fakemeter
-            self.total_export_kwh                 ,    # required for fakemeter
-            self.total_import_kvarh               ,    # required for fakemeter
-            self.total_export_kvarh               ,    # required for fakemeter
             self.phase_1_line_to_neutral_volts    ,    # required for fakemeter
             self.phase_2_line_to_neutral_volts    ,
             self.phase_3_line_to_neutral_volts    ,
@@ -63,53 +61,58 @@ class SDM630( grugbus.SlaveDevice ):
             self.phase_1_volt_amps                ,    # 
             self.phase_2_volt_amps                ,
             self.phase_3_volt_amps                ,
-            self.total_kwh                        ,    # required for fakemeter
-            self.total_kvarh                      ,    # required for fakemeter
             self.average_line_to_neutral_volts_thd,
             self.average_line_current_thd         ,
-            self.total_import_kwh,
-            self.total_export_kwh,
-        ]
-
-        self.reg_sets = list( self.reg_list_interleave( frequent_regs, all_regs ) )
+        ], config.POLL_PERIOD_SLOW )
+        self.scheduler.add( [
+            self.total_import_kwh                 ,    # required for fakemeter
+            self.total_export_kwh                 ,    # required for fakemeter
+            self.total_import_kvarh               ,    # required for fakemeter
+            self.total_export_kvarh               ,    # required for fakemeter
+            self.total_kwh                        ,    # required for fakemeter
+            self.total_kvarh                      ,    # required for fakemeter
+        ], config.POLL_PERIOD_ENERGY )
 
     async def read_coroutine( self ):
         mqtt  = self.mqtt
         topic = self.mqtt_topic
         while True:
-            for reg_set in self.reg_sets:
+            try:
                 try:
-                    await self.tick.wait()
-                    try:
-                        regs = await self.read_regs( reg_set )
-                    finally:
-                        # wake up other coroutines waiting for fresh values
-                        # even if there was a timeout
-                        self.event_power.set()
-                        self.event_power.clear()
-
-                    for reg in regs:
-                         mqtt.publish_reg( topic, reg )
+                    regs = await _read( self )
+                finally:
+                    # wake up other coroutines waiting for fresh values
+                    # even if there was a timeout
+                    self.event_power.set()
+                    self.event_power.clear()
+
+                # publish registers that changed, and the others once in a while
+                now = time.monotonic()
+                for reg in regs:
+                    if reg.changed or now >= self.keepalive.get( reg, 0 ):
+                        self.keepalive[ reg ] = now + config.MQTT_KEEPALIVE_PERIOD
+                        mqtt.publish_reg( topic, reg )
 
-                    mqtt.publish_value( topic+"is_online", int( self.is_online ))   # set by read_regs(), True if it succeeded, False otherwise
+                mqtt.publish_value( topic+"is_online", int( self.is_online ))   # set by read_regs(), True if it succeeded, False otherwise
 
-                    if config.MAINBOARD_FLASH_LEDS:
-                        self.mqtt.mqtt.publish( "nolog/pv/event/" + self.key, qos=0 )
+                if config.MAINBOARD_FLASH_LEDS:
+                    self.mqtt.mqtt.publish( "nolog/pv/event/" + self.key, qos=0 )
 
-                except (TimeoutError, ModbusException):
-                    await asyncio.sleep(1)
+            except (TimeoutError, ModbusException):
+                await asyncio.sleep(1)
 
-                except Exception:
-                    self.is_online = False
-                    log.exception(self.key+":")
-                    await asyncio.sleep(0.5)
+            except Exception:
+                self.is_online = False
+                log.exception(self.key+":")
+                await asyncio.sleep(0.5)
 
-            # wake up other coroutines waiting for fresh values
-            self.event_all.set()
-            self.event_all.clear()
+            if self.scheduler.cycle_done:
+                # wake up other coroutines waiting for fresh values
+                self.event_all.set()
+                self.event_all.clear()
 
-            # reload config if changed
-            self.tick.set(config.POLL_PERIOD_METER)
+                # reload config if changed
+                self.tick.set(config.POLL_PERIOD_METER)
 
 
 ########################################################################################
@@ -128,8 +131,9 @@ class SDM120( grugbus.SlaveDevice ):
         self.event_power = asyncio.Event()  # Fires every time frequent_regs below are read
         self.event_all   = asyncio.Event()  # Fires when all registers are read, for slower processes
         self.tick = Metronome( config.POLL_PERIOD_SOLIS_METER )
-        self.reg_sets = [[self.active_power]] * 9 + [[
-            self.active_power          ,
+        self.scheduler = grugbus.PollScheduler( self, cycle_period=config.POLL_PERIOD_SLOW )
+        self.scheduler.add( self.active_power )
+        self.scheduler.add( [
             # self.apparent_power        ,
             # self.reactive_power        ,
             # self.power_factor          ,
@@ -141,44 +145,79 @@ class SDM120( grugbus.SlaveDevice ):
             # self.export_reactive_energy,
             # self.total_active_energy   ,
             # self.total_reactive_energy ,
-        ]]
+        ], config.POLL_PERIOD_ENERGY )
         self.power_history = collections.deque( maxlen=3 )
+        self.poller = None      # grugbus.shm.PollerProcess that reads this meter, see make_poller()
 
     async def read_coroutine( self ):
         mqtt  = self.mqtt
         topic = self.mqtt_topic
-
         while True:
-            for reg_set in self.reg_sets:
+            try:
                 try:
-                    await self.tick.wait()
-                    try:
-                        regs = await self.read_regs( reg_set )
-                        self.power_history.append( self.active_power.value )
-                    finally:
-                        # wake up other coroutines waiting for fresh values
-                        self.event_power.set()
-                        self.event_power.clear()
-
-                    for reg in regs:
-                        mqtt.publish_reg( topic, reg )
+                    regs = await _read( self )
+                    self.power_history.append( self.active_power.value )
+                finally:
+                    # wake up other coroutines waiting for fresh values
+                    self.event_power.set()
+                    self.event_power.clear()
+
+                for reg in regs:
+                    mqtt.publish_reg( topic, reg )
+
+                if config.MAINBOARD_FLASH_LEDS:
+                    self.mqtt.mqtt.publish( "nolog/pv/event/" + self.key, qos=0 )
 
-                    if config.MAINBOARD_FLASH_LEDS:
-                        self.mqtt.mqtt.publish( "nolog/pv/event/" + self.key, qos=0 )
+            except (TimeoutError, ModbusException):
+                await asyncio.sleep(1)
 
-                except (TimeoutError, ModbusException):
-                    await asyncio.sleep(1)
+            except Exception:
+                self.is_online = False
+                log.exception(self.key+":")
+                await asyncio.sleep(1)
 
-                except Exception:
-                    self.is_online = False
-                    log.exception(self.key+":")
-                    await asyncio.sleep(1)
+            if self.scheduler.cycle_done:
+                # wake up other coroutines waiting for fresh values
+                self.event_all.set()
+                self.event_all.clear()
 
-            # wake up other coroutines waiting for fresh values
-            self.event_all.set()
-            self.event_all.clear()
+                # reload config if changed
+                self.tick.set(config.POLL_PERIOD_METER)
 
-            # reload config if changed
-            self.tick.set(config.POLL_PERIOD_METER)
 
 
+
+########################################################################################
+#
+#       Poller processes, see config.SHM_POLLERS and grugbus.shm
+#
+#       The meter is read in its own process, so its serial port is not delayed by
+#       everything else running in the controller's event loop.
+#
+########################################################################################
+async def _read( meter ):
+    # Reads registers that are due, or waits until the poller process has read them
+    if meter.poller:
+        regs = await meter.poller.wait( meter )
+        if not meter.is_online:
+            raise ModbusException( "%s: offline in poller process" % meter.key )
+        return meter.scheduler.loaded( regs )
+    await meter.tick.wait()
+    return await meter.scheduler.read()
+
+def make_poller( cls, client_cls, serial, params ):
+    # Called in the poller process: returns the meter with its modbus client, and the coroutine reading it
+    meter = cls( client_cls( **serial ), mqtt=None, mqtt_topic=None, **params )
+    return [meter], poll_coroutine( meter )
+
+async def poll_coroutine( meter ):
+    while True:
+        try:
+            await meter.tick.wait()
+            await meter.scheduler.read()
+        except (TimeoutError, ModbusException):
+            await asyncio.sleep(1)
+        except Exception:
+            meter.is_online = False
+            log.exception( meter.key+":" )
+            await asyncio.sleep(1)
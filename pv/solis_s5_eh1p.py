@@ -23,7 +23,10 @@ log = logging.getLogger(__name__)
 ########################################################################################
 class Solis( grugbus.SlaveDevice ):
     def __init__( self, modbus, modbus_addr, key, name, local_meter, fake_meter, mqtt, mqtt_topic ):
-        super().__init__( modbus, modbus_addr, key, name, Solis_S5_EH1P_6K_2020_Extras.MakeRegisters() )
+        super().__init__( modbus, modbus_addr, key, name, Solis_S5_EH1P_6K_2020_Extras.MakeRegisters(),
+                          profile = grugbus.probe.profile_path( Solis_S5_EH1P_6K_2020_Extras ),
+                          decode_accidental = True,
+                          skip_unchanged    = True )
 
         self.local_meter = local_meter        # on AC grid port
         self.fake_meter  = fake_meter    # meter emulation on meter port
@@ -31,6 +34,7 @@ class Solis( grugbus.SlaveDevice ):
         self.mqtt        = mqtt
         self.mqtt_topic  = mqtt_topic
         self.mqtt_written_regs = {}
+        self.keepalive   = {}   # reg: time to publish it even if it did not change
         mqtt.register_callbacks( self )
 
         # Get fake meter lag from Controller
@@ -58,7 +62,10 @@ class Solis( grugbus.SlaveDevice ):
         #   TODO: new battery current register returns 0 when inverter is off, check if it also does when battery is full
         #   TODO: new battery current register behavior when fully charged
 
-        frequent_regs = [
+        # Read power registers on every tick, the rest less often.
+        # The scheduler merges slow registers into power reads when it's cheap.
+        self.scheduler = grugbus.PollScheduler( self, cycle_period=config.POLL_PERIOD_SLOW )
+        self.scheduler.add( [
                 #33049 - 33057
                 self.mppt1_voltage              ,
                 self.mppt1_current              ,
@@ -69,14 +76,9 @@ class Solis( grugbus.SlaveDevice ):
                 self.battery_current            ,
 
                 self.battery_current_direction  ,
-            ]
-
-        all_regs = [
-                self.energy_generated_today               ,  
-                self.energy_generated_yesterday           ,      
-
-                self.battery_charge_energy_today          ,
+            ] )
 
+        self.scheduler.add( [
                 self.phase_a_voltage                      ,
 
                 self.temperature                          ,
@@ -101,9 +103,6 @@ class Solis( grugbus.SlaveDevice ):
                 # self.bms_battery_fault_information_02     ,
                 self.backup_load_power                    ,
 
-                self.battery_charge_energy_today          ,
-                self.battery_discharge_energy_today       ,
-
                 self.battery_max_charge_current           ,
                 self.battery_max_discharge_current        ,
 
@@ -113,10 +112,15 @@ class Solis( grugbus.SlaveDevice ):
                 self.rwr_backup_output_enabled            ,
 
                 self.leakage_current
-            ]
+            ], config.POLL_PERIOD_SLOW )
 
-        # Build modbus requests: read frequent_regs on every request, plus one chunk out of all_regs
-        self.reg_sets = list( self.reg_list_interleave( frequent_regs, all_regs ) )
+        self.scheduler.add( [
+                self.energy_generated_today               ,  
+                self.energy_generated_yesterday           ,      
+
+                self.battery_charge_energy_today          ,
+                self.battery_discharge_energy_today       ,
+            ], config.POLL_PERIOD_ENERGY )
 
     async def set_meter_type_and_location( self ):
         # set meter type remotely to make it easy to emulate different fakemeters
@@ -125,7 +129,7 @@ class Solis( grugbus.SlaveDevice ):
         elif self.fake_meter.meter_type == Eastron_SDM120:     mt = 4
         mt |= {"grid":0x100, "load":0x200}[self.fake_meter.meter_placement]
         if self.rwr_meter1_type_and_location.value == None:
-            await self.rwr_meter1_type_and_location.read()
+            await self.rwr_meter1_type_and_location.read( max_age=config.POLL_PERIOD_SLOW )
         await self.rwr_meter1_type_and_location.write_if_changed( mt )
 
     async def read_coroutine( self ):
@@ -134,10 +138,11 @@ class Solis( grugbus.SlaveDevice ):
             await self.adjust_time()
             await self.set_meter_type_and_location()
             # configure inverter
-            for reg, value in  [(self.rwr_battery_charge_current_maximum_setting, 100.0),
-                                (self.rwr_battery_discharge_current_maximum_setting, 100.0)]:
-                await reg.read()
-                await reg.write_if_changed( value )
+            settings = [(self.rwr_battery_charge_current_maximum_setting, 100.0),
+                        (self.rwr_battery_discharge_current_maximum_setting, 100.0)]
+            # no need to read if the poller just did. Writes are gathered so they are merged into one transaction.
+            await self.read_regs( [ reg for reg, value in settings ], max_age=config.POLL_PERIOD_SLOW )
+            await asyncio.gather( *( reg.write_if_changed( value ) for reg, value in settings ))
 
         except (TimeoutError, ModbusException): 
             # if inverter is disconnected because the Solis Wifi Stick is in, do not abort the rest of the program
@@ -145,76 +150,87 @@ class Solis( grugbus.SlaveDevice ):
 
         mqtt = self.mqtt
         topic = self.mqtt_topic
-        startup_done = False
+        # At startup, all registers are due, so they are read at once.
+        # Holes are chosen by the cost model: if a hole can't be read, read_regs() splits the chunk
+        # and fixes the plan, and the device profile (see grugbus.probe) avoids it from the start.
         while True:
-            # At startup, read all registers at once, do not wait.
-            for n, reg_set in enumerate( self.reg_sets if startup_done else [ list(set(sum(self.reg_sets,[]))) ] ):
+            try:
+                await self.tick.wait()
                 try:
-                    await self.tick.wait()
-                    try:
-                        regs = set( await self.read_regs( reg_set, max_hole_size=8 ) )
-
-                        #
-                        #   Process values. Do not await until it is done, to prevent other tasks from seeing partial results
-                        #   Code below is all conditional, depending on which registers were read
-                        #
-
-                        # Add polarity to battery parameters
-                        if self.battery_current_direction in regs:
-                            regs.remove( self.battery_current_direction )
-                            if self.battery_current_direction.value:    # positive current/power means charging, negative means discharging
-                                self.battery_current.value     *= -1
-
-                            # offset calibration
-                            if f := config.CALIBRATION.get( self.mqtt_topic + "battery_current"):
-                                self.battery_current.value = f( self.battery_current.value )
-
-                            self.battery_power.value       = self.battery_current.value * self.battery_voltage.value
-                            regs.add( self.battery_power )
-
-                        # Add useful metrics to avoid asof joins in database
-                        if self.mppt1_voltage in regs:
-                            self.mppt1_power.value = int( self.mppt1_current.value * self.mppt1_voltage.value )
-                            self.mppt2_power.value = int( self.mppt2_current.value * self.mppt2_voltage.value )
-                            regs.add( self.mppt1_power )
-                            regs.add( self.mppt2_power )
-
-                        # if self.bms_battery_current in regs:
-                        #     if self.battery_current_direction.value:    # positive current/power means charging, negative means discharging
-                        #         self.bms_battery_current.value *= -1
-                            # self.bms_battery_power.value = int( self.bms_battery_current.value * self.bms_battery_voltage.value )
-                            # regs.add( self.bms_battery_power )
-
-                        # Prepare MQTT publish
-                        for reg in regs:
+                    regs = set( await self.scheduler.read() )
+                    computed = []   # registers computed here, always published
+
+                    #
+                    #   Process values. Do not await until it is done, to prevent other tasks from seeing partial results
+                    #   Code below is all conditional, depending on which registers were read
+                    #
+
+                    # Add polarity to battery parameters
+                    if self.battery_current_direction in regs:
+                        regs.remove( self.battery_current_direction )
+                        if self.battery_current_direction.value:    # positive current/power means charging, negative means discharging
+                            self.battery_current.value     *= -1
+
+                        # offset calibration
+                        if f := config.CALIBRATION.get( self.mqtt_topic + "battery_current"):
+                            self.battery_current.value = f( self.battery_current.value )
+
+                        # value was modified, so it must be decoded again on next read, even if it did not change
+                        self.invalidate_raw( (self.battery_current,) )
+                        self.battery_power.value       = self.battery_current.value * self.battery_voltage.value
+                        regs.discard( self.battery_current )
+                        regs.discard( self.battery_power )
+                        computed.append( self.battery_current )
+                        computed.append( self.battery_power )
+
+                    # Add useful metrics to avoid asof joins in database
+                    if self.mppt1_voltage in regs:
+                        self.mppt1_power.value = int( self.mppt1_current.value * self.mppt1_voltage.value )
+                        self.mppt2_power.value = int( self.mppt2_current.value * self.mppt2_voltage.value )
+                        computed.append( self.mppt1_power )
+                        computed.append( self.mppt2_power )
+
+                    # if self.bms_battery_current in regs:
+                    #     if self.battery_current_direction.value:    # positive current/power means charging, negative means discharging
+                    #         self.bms_battery_current.value *= -1
+                        # self.bms_battery_power.value = int( self.bms_battery_current.value * self.bms_battery_voltage.value )
+                        # regs.add( self.bms_battery_power )
+
+                    # Prepare MQTT publish: registers that changed, and the others once in a while
+                    now = time.monotonic()
+                    for reg in regs:
+                        if reg.changed or now >= self.keepalive.get( reg, 0 ):
+                            self.keepalive[ reg ] = now + config.MQTT_KEEPALIVE_PERIOD
                             mqtt.publish_reg( topic, reg )
+                    for reg in computed:
+                        mqtt.publish_reg( topic, reg )
 
-                        if config.MAINBOARD_FLASH_LEDS:
-                            self.mqtt.mqtt.publish( "nolog/pv/event/" + self.key, qos=0 )
+                    if config.MAINBOARD_FLASH_LEDS:
+                        self.mqtt.mqtt.publish( "nolog/pv/event/" + self.key, qos=0 )
 
-                    finally:
-                        # wake up other coroutines waiting for fresh values
-                        self.event_power.set()
-                        self.event_power.clear()
+                finally:
+                    # wake up other coroutines waiting for fresh values
+                    self.event_power.set()
+                    self.event_power.clear()
 
 
-                except (TimeoutError, ModbusException):
-                    # note grugbus.Device logs the exception and sets self.is_online is set to False
-                    # when communication fails, no need to do it again here
-                    await asyncio.sleep(1)
+            except (TimeoutError, ModbusException):
+                # note grugbus.Device logs the exception and sets self.is_online is set to False
+                # when communication fails, no need to do it again here
+                await asyncio.sleep(1)
 
-                except Exception:
-                    self.is_online = False
-                    log.exception(self.key+":")
-                    await asyncio.sleep(1)
+            except Exception:
+                self.is_online = False
+                log.exception(self.key+":")
+                await asyncio.sleep(1)
 
-            # wake up other coroutines waiting for fresh values
-            self.event_all.set()
-            self.event_all.clear()
-            startup_done = True
+            if self.scheduler.cycle_done:
+                # wake up other coroutines waiting for fresh values
+                self.event_all.set()
+                self.event_all.clear()
 
-            # reload config if changed
-            self.tick.set( config.POLL_PERIOD_SOLIS )
+                # reload config if changed
+                self.tick.set( config.POLL_PERIOD_SOLIS )
 
     def is_ongrid( self ):
         return not self.is_offgrid()
@@ -243,20 +259,22 @@ class Solis( grugbus.SlaveDevice ):
         await self.write_regs( self.get_time_regs() )
 
     async def adjust_time( self ):
-        inverter_time = await self.get_time()
-        dt = datetime.datetime.now()
-        log.info( "Inverter time: %s, Pi time: %s" % (inverter_time.isoformat(), dt.isoformat()))
-        deltat = abs( dt-inverter_time )
-        if deltat < datetime.timedelta( seconds=2 ):
-            log.info( "Inverter time is OK, we won't set it." )
-        else:
-            if deltat > datetime.timedelta( seconds=4000 ):
-                log.info( "Pi time seems old, is NTP active?")
+        # hold the bus, so other transactions don't delay setting the time after reading it
+        async with self.session():
+            inverter_time = await self.get_time()
+            dt = datetime.datetime.now()
+            log.info( "Inverter time: %s, Pi time: %s" % (inverter_time.isoformat(), dt.isoformat()))
+            deltat = abs( dt-inverter_time )
+            if deltat < datetime.timedelta( seconds=2 ):
+                log.info( "Inverter time is OK, we won't set it." )
             else:
-                log.info( "Setting inverter time to Pi time" )
-                await self.set_time( dt )
-                inverter_time = await self.get_time()
-                log.info( "Inverter time: %s, Pi time: %s" % (inverter_time.isoformat(), dt.isoformat()))
+                if deltat > datetime.timedelta( seconds=4000 ):
+                    log.info( "Pi time seems old, is NTP active?")
+                else:
+                    log.info( "Setting inverter time to Pi time" )
+                    await self.set_time( dt )
+                    inverter_time = await self.get_time()
+                    log.info( "Inverter time: %s, Pi time: %s" % (inverter_time.isoformat(), dt.isoformat()))
 
     @MQTTWrapper.decorate_callback( "read_regs", orjson.loads )
     async def cb_read_regs( self, topic, payload, qos, properties ):
@@ -275,11 +293,13 @@ class Solis( grugbus.SlaveDevice ):
         print("Callback:", self.key, topic, payload )
         for addr, value in payload:
             if reg := self.regs_by_key.get( addr ) or self.regs_by_addr.get( addr ):
-                old_value = await reg.read()
-                if reg.key not in self.mqtt_written_regs:
-                    self.mqtt_written_regs[reg.key] = old_value
-                await reg.write( value )
-                print( "Reg:", reg.key, "read", old_value, "write", value, "read", await reg.read() )
+                async with self.session():
+                    old_value = await reg.read( max_age=config.POLL_PERIOD_SLOW )
+                    if reg.key not in self.mqtt_written_regs:
+                        self.mqtt_written_regs[reg.key] = old_value
+                    reg.value = value
+                    await self.write_read_regs( [reg], [reg] )
+                print( "Reg:", reg.key, "read", old_value, "write", value, "read", reg.value )
             else:
                 resp = await self.modbus.read_holding_registers( addr, 1, self.bus_address )
                 old_value = resp.registers[0]
@@ -25,6 +25,14 @@ import pv.solis_s5_eh1p, pv.meters
 import config
 from misc import *
 
+# serial modbus client, see grugbus.rtu
+if not config.GRUGBUS_NATIVE_RTU:
+    SerialClient = AsyncModbusSerialClient
+elif config.GRUGBUS_SERIAL_THREAD:
+    SerialClient = grugbus.rtu.ThreadedRtuClient
+else:
+    SerialClient = grugbus.rtu.RtuClient
+
 ###########################################################################################
 #
 #       This file starts and runs the PV controller.
@@ -205,25 +213,16 @@ class Controller:
 
         #   Main smartmeter
         #
-        self.meter = pv.meters.SDM630(
-            AsyncModbusSerialClient( **config.METER["SERIAL"] ), 
-            mqtt        = self.mqtt,
-            mqtt_topic  = "pv/meter/",
-            **config.METER["PARAMS"],
-        )
+        self.pollers = []
+        self.meter = self.make_meter( pv.meters.SDM630, config.METER, "pv/meter/" )
 
         #
         #   Solis inverters, local meters, fake meters
         #
         self.inverters = [
             pv.solis_s5_eh1p.Solis( 
-                AsyncModbusSerialClient( **cfg["SERIAL"] ),
-                local_meter = pv.meters.SDM120( 
-                    AsyncModbusSerialClient( **cfg["LOCAL_METER"]["SERIAL"] ),
-                    mqtt       = self.mqtt,
-                    mqtt_topic ="pv/%s/meter/" % key,
-                    **cfg["LOCAL_METER"]["PARAMS"],
-                ),
+                SerialClient( **cfg["SERIAL"] ),
+                local_meter = self.make_meter( pv.meters.SDM120, cfg["LOCAL_METER"], "pv/%s/meter/" % key ),
                 fake_meter = FakeSmartmeter( 
                     meter_type      = Acrel_1_Phase,
                     # meter_type      = Eastron_SDM120, # Acrel_1_Phase,
@@ -252,13 +251,35 @@ class Controller:
                     tg.create_task( self.log_coroutine( "%s: Read"                   %v.key, v.read_coroutine() ))
                     tg.create_task( self.log_coroutine( "%s: Read local meter"       %v.key, v.local_meter.read_coroutine() ))
                     tg.create_task( self.log_coroutine( "%s: Fakemeter Modbus server"%v.key, v.fake_meter.start_server() ))
+                    tg.create_task( self.log_coroutine( "%s: Stats"                  %v.key, v.publish_stats_coroutine() ))
+                    if not v.local_meter.poller:
+                        tg.create_task( self.log_coroutine( "%s: Stats local meter"  %v.key, v.local_meter.publish_stats_coroutine() ))
                     tg.create_task( pv.reload.reloadable_coroutine( "Powersave: %s" % v.key, lambda: pv.controller.inverter_powersave_coroutine, self, v ))
 
                 tg.create_task( self.log_coroutine( "Read: main meter",          self.meter.read_coroutine() ))
+                if not self.meter.poller:
+                    tg.create_task( self.log_coroutine( "Stats: main meter",     self.meter.publish_stats_coroutine() ))
+                for poller in self.pollers:
+                    tg.create_task( self.log_coroutine( "Poller: %s" % poller.name, poller.run() ))
                 tg.create_task( self.log_coroutine( "Reload python modules",     pv.reload.reload_coroutine() ))
                 tg.create_task( pv.reload.reloadable_coroutine( "Inverter fan control", lambda: pv.controller.inverter_fan_coroutine, self ))
                 tg.create_task( pv.reload.reloadable_coroutine( "Power coroutine"     , lambda: pv.controller.power_coroutine, self ))
 
+                devices = { d.key: d for d in [self.meter] + self.inverters + [v.local_meter for v in self.inverters] }
+
+                # one bus stats publisher per serial port, under the topic of its first device
+                # (meters read by poller processes have no serial port here)
+                buses = {}
+                for d in devices.values():
+                    if d.modbus:
+                        buses.setdefault( d.bus, d )
+                for bus, d in buses.items():
+                    tg.create_task( self.log_coroutine( "Bus stats: %s" % d.key, bus.publish_coroutine( self.mqtt, d.mqtt_topic+"bus/" ) ))
+
+                for cfg in config.GATEWAYS:
+                    gw = grugbus.gateway.Gateway( [ devices[k] for k in cfg["devices"] ], max_age=cfg.get( "max_age", 1.0 ))
+                    tg.create_task( self.log_coroutine( "Gateway: port %d" % cfg["port"], gw.serve( cfg["port"], framer=cfg.get( "framer", "tcp" ))))
+
         except (KeyboardInterrupt, CancelledError):
             print("Terminated.")
         finally:
@@ -266,6 +287,15 @@ class Controller:
                 self.mqtt.write_stats( f )
             await self.mqtt.mqtt.disconnect()
 
+    def make_meter( self, cls, cfg, mqtt_topic ):
+        # With config.SHM_POLLERS, the meter is read in its own process, and this one has no modbus client
+        if not config.SHM_POLLERS:
+            return cls( SerialClient( **cfg["SERIAL"] ), mqtt=self.mqtt, mqtt_topic=mqtt_topic, **cfg["PARAMS"] )
+        meter = cls( None, mqtt=self.mqtt, mqtt_topic=mqtt_topic, **cfg["PARAMS"] )
+        meter.poller = grugbus.shm.PollerProcess( "pv_"+meter.key, [meter], pv.meters.make_poller, cls, SerialClient, cfg["SERIAL"], cfg["PARAMS"] )
+        self.pollers.append( meter.poller )
+        return meter
+
     async def log_coroutine( self, title, fut ):
         log.info("Start:"+title )
         try:        await fut
@@ -23,6 +23,14 @@ import pv.reload, pv.router, pv.meters
 import config
 from misc import *
 
+# serial modbus client, see grugbus.rtu
+if not config.GRUGBUS_NATIVE_RTU:
+    SerialClient = AsyncModbusSerialClient
+elif config.GRUGBUS_SERIAL_THREAD:
+    SerialClient = grugbus.rtu.ThreadedRtuClient
+else:
+    SerialClient = grugbus.rtu.RtuClient
+
 ###########################################################################################
 #
 #       This file starts and runs the PV router.
@@ -84,7 +92,7 @@ class Master():
         #
         #   EVSE and its smartmeter, both on the same modbus port
         #
-        modbus_evse = AsyncModbusSerialClient( **config.EVSE["SERIAL"] )
+        modbus_evse = SerialClient( **config.EVSE["SERIAL"] )
         self.evse  = pv.evse_abb_terra.EVSE( 
             modbus_evse,
             **config.EVSE["PARAMS"], 
@@ -99,7 +107,7 @@ class Master():
         )
 
         # add voltage to EVSE meter register poll list
-        self.evse.local_meter.reg_sets[0].append( self.evse.local_meter.voltage )
+        self.evse.local_meter.scheduler.add( self.evse.local_meter.voltage )
         self.router = pv.router.Router( mgr = self, mqtt = self.mqtt, mqtt_topic = "pv/router/" )
 
         pv.reload.add_module_to_reload( "config", lambda: (self.mqtt.load_rate_limit(), self.router.load_config()) ) # reload rate limit configuration
@@ -109,6 +117,9 @@ class Master():
             async with asyncio.TaskGroup() as tg:
                 tg.create_task( self.log_coroutine( "Read: %s"             %self.evse.key, self.evse.read_coroutine() ))
                 tg.create_task( self.log_coroutine( "Read: %s local meter" %self.evse.key, self.evse.local_meter.read_coroutine() ))
+                tg.create_task( self.log_coroutine( "Bus stats: %s"        %self.evse.key, self.evse.bus.publish_coroutine( self.mqtt, "pv/evse/bus/" ) ))
+                tg.create_task( self.log_coroutine( "Stats: %s"            %self.evse.key, self.evse.publish_stats_coroutine() ))
+                tg.create_task( self.log_coroutine( "Stats: %s local meter"%self.evse.key, self.evse.local_meter.publish_stats_coroutine() ))
                 tg.create_task( self.log_coroutine( "Reload python modules",     pv.reload.reload_coroutine() ))
                 tg.create_task( pv.reload.reloadable_coroutine( "Router",     lambda: pv.router.route_coroutine, self ))
 